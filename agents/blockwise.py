@@ -0,0 +1,110 @@
+import argparse
+import h5py
+import numpy as np
+import torch
+import yaml
+
+from environments.multicut import MulticutEmbeddingsEnv, State
+from data.preprocess import compute_graph_data
+from models.agent_model import Agent
+from utils.blockwise import get_blocks, BlockGraphStitcher, project_blockwise
+from utils.distances import CosineDistance, L2Distance
+from utils.graphs import graph_from_uv_ids
+from utils.multicut_solvers import get_solver_kwargs
+from utils.training_helpers import Forwarder
+from utils.yaml_conv_parser import dict_to_attrdict
+
+
+class BlockwiseSegmenter(object):
+    """
+    segments images or volumes that are too large for one episode. The data is tiled into blocks with halo, the
+    feature extractor and the agent predict the edges of the superpixel graph of each block and the block graphs are
+    stitched into one global graph that is solved with a final multicut.
+    Blocks have to be 2d, volumes are processed with blocks of one slice and a halo of zero along z.
+    """
+
+    def __init__(self, cfg, model, device, min_size=None):
+        self.cfg = cfg
+        self.model = model
+        self.device = device
+        self.min_size = min_size
+        self.env = MulticutEmbeddingsEnv(cfg, device, phase="validation")
+        self.forwarder = Forwarder()
+        self.use_edge_feat = "edge_feat" in cfg.train_data_keys
+        self.use_node_feat = "node_feat" in cfg.train_data_keys
+
+    def predict_edges(self, raw, graph_data):
+        """
+        runs the agent on the superpixel graph of one 2d block
+        :param raw: np.ndarray of shape (C, H, W)
+        :param graph_data: dict as returned by data.preprocess.compute_graph_data
+        :return: the boundary probability of every edge
+        """
+        edges = torch.from_numpy(graph_data["edges"]).to(self.device)
+        if edges.shape[1] < max(self.cfg.s_subgraph):
+            # too small to sample subgraphs, fall back to the mean affinity along the edges
+            return graph_data["edge_feat"][1]
+        sp_seg = torch.from_numpy(graph_data["superpixels"])[None].to(self.device)
+        edge_feat = [torch.from_numpy(graph_data["edge_feat"].T).to(self.device)] if self.use_edge_feat else None
+        node_feat = [torch.from_numpy(graph_data["node_feat"].T).to(self.device)] if self.use_node_feat else None
+        rags = [graph_from_uv_ids(graph_data["edges"].T, int(graph_data["superpixels"].max()) + 1)]
+        self.env.set_data(self.env.prepare_data(raw=torch.from_numpy(raw).float()[None].to(self.device),
+                                                gt=torch.zeros_like(sp_seg), edge_ids=[edges], gt_edges=None,
+                                                sp_seg=sp_seg, rags=rags, edge_feat=edge_feat, node_feat=node_feat))
+        self.env.reset()
+        distr, *_ = self.forwarder.forward(self.model, self.env.get_state(), State, self.device, grad=False,
+                                           post_data=False)
+        return torch.sigmoid(distr.loc).squeeze(-1).cpu().numpy()
+
+    def segment(self, raw, out, block_shape, halo):
+        """
+        :param raw: array like of shape (C, *spatial), e.g. an h5 dataset
+        :param out: zero initialized integer array like of the spatial shape, holds the segmentation afterwards
+        :param block_shape: spatial block shape, at most two axes can be larger than one
+        :param halo: halo along each spatial axis
+        """
+        shape = raw.shape[1:]
+        stitcher = BlockGraphStitcher(out)
+        for block in get_blocks(shape, block_shape, halo):
+            raw_block = np.asarray(raw[(slice(None),) + block.outer])
+            block_shape_2d = tuple(s for s in raw_block.shape[1:] if s > 1)
+            assert len(block_shape_2d) == 2, "the agent can only process 2d blocks"
+            raw_2d = raw_block.reshape((raw_block.shape[0],) + block_shape_2d)
+            graph_data = compute_graph_data(raw_2d, min_size=self.min_size)
+            edge_probs = self.predict_edges(raw_2d, graph_data)
+            sp_seg = graph_data["superpixels"].reshape(raw_block.shape[1:])
+            stitcher.add_block(block, sp_seg, graph_data["edges"], edge_probs)
+        node_labels = stitcher.solve_multicut(**get_solver_kwargs(self.cfg, "validation"))
+        project_blockwise(out, node_labels, get_blocks(shape, block_shape, halo), out)
+        return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="block-wise segmentation of a large image or volume")
+    parser.add_argument("config", help="config of the trained agent")
+    parser.add_argument("model", help="state dict of the trained agent")
+    parser.add_argument("in_file", help="h5 file with the raw data of shape (C, *spatial)")
+    parser.add_argument("out_file", help="h5 file for the segmentation")
+    parser.add_argument("--raw_key", default="raw")
+    parser.add_argument("--out_key", default="segmentation")
+    parser.add_argument("--block_shape", type=int, nargs="+", required=True)
+    parser.add_argument("--halo", type=int, nargs="+", required=True)
+    parser.add_argument("--min_size", type=int, default=None, help="minimum superpixel size")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = dict_to_attrdict({key: val["value"] for key, val in yaml.safe_load(f).items()})
+    device = torch.device("cuda:0")
+    distance = CosineDistance() if cfg.distance == 'cosine' else L2Distance()
+    model = Agent(cfg, State, distance, device)
+    model.load_state_dict(torch.load(args.model))
+    model.cuda(device)
+    model.eval()
+
+    with h5py.File(args.in_file, "r") as f_in, h5py.File(args.out_file, "a") as f_out:
+        raw = f_in[args.raw_key]
+        if args.out_key in f_out:
+            del f_out[args.out_key]
+        out = f_out.create_dataset(args.out_key, shape=raw.shape[1:], dtype="uint64", fillvalue=0,
+                                   chunks=tuple(min(b, s) for b, s in zip(args.block_shape, raw.shape[1:])))
+        BlockwiseSegmenter(cfg, model, device, args.min_size).segment(raw, out, args.block_shape, args.halo)
@@ -15,16 +15,19 @@ import threading
 from skimage.morphology import dilation
 
 from environments.multicut import MulticutEmbeddingsEnv, State
-from data.spg_dset import SpgDset
+from environments.vec_multicut import VecMulticutEnv
+from data.samplers import ShapeBucketBatchSampler
+from data.spg_dset import SpgDset, collate_graph_samples
+from data.spg_mmap_dset import SpgMmapDset
 from models.agent_model import Agent
 from utils.exploration_functions import RunningAverage
 from utils.general import soft_update_params, set_seed_everywhere, get_colored_edges_in_sseg, pca_project, \
     random_label_cmap
 from utils.replay_memory import TransitionData_ts
-from utils.graphs import get_joint_sg_logprobs_edges
+from utils.graphs import get_joint_sg_logprobs_edges, get_joint_sg_logprobs_nodes
 from utils.distances import CosineDistance, L2Distance
 from utils.yaml_conv_parser import dict_to_attrdict
-from utils.training_helpers import update_env_data, state_to_cpu, Forwarder
+from utils.training_helpers import update_env_data, state_to_cpu, Forwarder, EnvDataPrefetcher
 from utils.metrics import AveragePrecision, ClusterMetrics
 
 
@@ -88,19 +91,42 @@ class AgentSacTrainer(object):
             self.model.load_state_dict(torch.load(self.cfg.agent_model_name))
         # finished with prepping
 
-        self.train_dset = SpgDset(self.cfg.train_data_dir, dict_to_attrdict(self.cfg.patch_manager),
-                                  dict_to_attrdict(self.cfg.train_data_keys), max(self.cfg.s_subgraph))
-        self.val_dset = SpgDset(self.cfg.val_data_dir, dict_to_attrdict(self.cfg.patch_manager),
-                                dict_to_attrdict(self.cfg.val_data_keys), max(self.cfg.s_subgraph))
+        dset_class = SpgMmapDset if self.cfg.get("data_format", "h5") == "mmap" else SpgDset
+        # sample_cache_gb is the budget of the host. Without data workers all explorers share the cache of the
+        # dataset, otherwise every data worker of every explorer has its own cache
+        n_data_workers = self.cfg.get("n_data_workers", 0)
+        n_sample_caches = self.cfg.n_explorers * n_data_workers if n_data_workers > 0 else 1
+        self.train_dset = dset_class(self.cfg.train_data_dir, dict_to_attrdict(self.cfg.patch_manager),
+                                     dict_to_attrdict(self.cfg.train_data_keys), max(self.cfg.s_subgraph),
+                                     sample_cache_bytes=int(self.cfg.get("sample_cache_gb", 0) * 2 ** 30 /
+                                                            n_sample_caches),
+                                     sample_cache_policy=self.cfg.get("sample_cache_policy", "lru"))
+        self.val_dset = dset_class(self.cfg.val_data_dir, dict_to_attrdict(self.cfg.patch_manager),
+                                   dict_to_attrdict(self.cfg.val_data_keys), max(self.cfg.s_subgraph))
 
         self.segm_metric = AveragePrecision()
         self.clst_metric = ClusterMetrics()
         self.global_counter = 0
 
+    def get_data_loader(self, dset, batch_size, shuffle, rank=0, world_size=1):
+        """
+        graphs and rags are produced in the dataset, so data preparation runs in the n_data_workers processes.
+        Each of the world_size loaders only sees its own shard of the data.
+        """
+        n_workers = self.cfg.get("n_data_workers", 0)
+        kwargs = {}
+        if n_workers > 0:
+            kwargs = {"persistent_workers": True, "prefetch_factor": self.cfg.get("prefetch_factor", 2)}
+        # images of different shapes are only batched with patches of the same shape
+        batch_sampler = ShapeBucketBatchSampler(dset.get_bucket_ids(), batch_size, shuffle,
+                                                seed=self.cfg.get("random_seed", 0), rank=rank, world_size=world_size)
+        return DataLoader(dset, batch_sampler=batch_sampler, pin_memory=True, num_workers=n_workers,
+                          collate_fn=collate_graph_samples, **kwargs)
+
     def validate(self):
         return
         """validates the prediction against the method of clustering the embedding space"""
-        env = MulticutEmbeddingsEnv(self.cfg, self.device)
+        env = MulticutEmbeddingsEnv(self.cfg, self.device, phase="validation")
         if self.cfg.verbose:
             print("\n\n###### start validate ######", end='')
         self.model.eval()
@@ -112,11 +138,11 @@ class AgentSacTrainer(object):
         map_scores = []
         ex_raws, ex_sps, ex_gts, ex_mc_gts, ex_feats, ex_emb, ex_n_emb, ex_rl, edge_ids, rewards, actions = [[] for _ in
                                                                                                              range(11)]
-        dloader = iter(DataLoader(self.val_dset, batch_size=1, shuffle=False, pin_memory=True, num_workers=0))
+        dloader = iter(self.get_data_loader(self.val_dset, batch_size=1, shuffle=False))
         acc_reward = 0
 
         for it in range(n_examples):
-            update_env_data(env, dloader, self.val_dset, self.device,
+            update_env_data(env, dloader, self.device,
                             with_gt_edges="sub_graph_dice" in self.cfg.reward_function)
             env.reset()
             state = env.get_state()
@@ -265,8 +291,10 @@ class AgentSacTrainer(object):
             actor_loss = torch.tensor([0.0], device=actor_Q[0].device)
             alpha_loss = torch.tensor([0.0], device=actor_Q[0].device)
             _log_prob, sg_entropy = [], []
+            get_joint_sg_logprobs = get_joint_sg_logprobs_nodes if self.cfg.get("node_actions", False) else \
+                get_joint_sg_logprobs_edges
             for i, sz in enumerate(self.cfg.s_subgraph):
-                ret = get_joint_sg_logprobs_edges(log_prob, distribution.scale, obs, i, sz)
+                ret = get_joint_sg_logprobs(log_prob, distribution.scale, obs, i, sz)
                 _log_prob.append(ret[0])
                 sg_entropy.append(ret[1])
 
@@ -322,6 +350,10 @@ class AgentSacTrainer(object):
             if min_entropy != "nl":
                 wandb.log({"min_entropy": min_entropy}, step=self.global_counter)
             wandb.log({"mov_avg/critic": self.mov_sum_losses.critic.avg}, step=self.global_counter)
+            # with data workers the samples are cached in the workers, the counters here would always be zero
+            if self.train_dset.sample_cache is not None and self.cfg.get("n_data_workers", 0) == 0:
+                wandb.log({"data/sample_cache_hit_rate": self.train_dset.sample_cache.hit_rate},
+                          step=self.global_counter)
             wandb.log({"mov_avg/actor": self.mov_sum_losses.actor.avg}, step=self.global_counter)
             wandb.log({"mov_avg/temperature": self.mov_sum_losses.temperature.avg}, step=self.global_counter)
             wandb.log({"lr/critic": self.optimizers.critic_shed.optimizer.param_groups[0]['lr']},
@@ -380,9 +412,19 @@ class AgentSacTrainer(object):
             print('found ', self.train_dset.length, " training data patches")
             print('found ', self.val_dset.length, "validation data patches")
             print('training with seed: ' + str(rn))
+        # every data update of an explorer consumes one batch per environment, an explorer with fewer batches per
+        # epoch would never push a transition and the trainer would wait for a full memory forever
+        n_envs = self.cfg.get("n_envs_per_explorer", 1)
+        for i in range(self.cfg.n_explorers):
+            n_batches = len(self.get_explorer_data_loader(i))
+            if n_batches < n_envs:
+                raise ValueError(f"explorer {i} gets {n_batches} batches per epoch but needs at least {n_envs}, use "
+                                 f"fewer explorers, hosts or n_envs_per_explorer")
+        # the explorers start every epoch together, so they shuffle with the same epoch and their shards are disjoint
+        self.epoch_barrier = threading.Barrier(self.cfg.n_explorers)
         explorers = []
         for i in range(self.cfg.n_explorers):
-            explorers.append(threading.Thread(target=self.explore))
+            explorers.append(threading.Thread(target=self.explore, args=(i,)))
         [explorer.start() for explorer in explorers]
 
         self.memory.is_full_event.wait()
@@ -398,31 +440,57 @@ class AgentSacTrainer(object):
             print('\n\n###### training finished ######')
         return
 
-    def explore(self):
-        env = MulticutEmbeddingsEnv(self.cfg, self.device)
+    def get_explorer_data_loader(self, explorer_id):
+        # explorers of all hosts explore disjoint shards of the data. The explorers of one host share their epochs,
+        # hosts are not synchronized, so the shards of two hosts can overlap once they are in different epochs
+        n_explorers = self.cfg.n_explorers
+        return self.get_data_loader(self.train_dset, batch_size=self.cfg.batch_size, shuffle=True,
+                                    rank=self.cfg.get("host_rank", 0) * n_explorers + explorer_id,
+                                    world_size=self.cfg.get("n_hosts", 1) * n_explorers)
+
+    def explore(self, explorer_id=0):
+        # every explorer runs n_envs_per_explorer episodes at once with one forward of the policy
+        env = VecMulticutEnv(self.cfg, self.device, self.cfg.get("n_envs_per_explorer", 1))
         tau = 1
+        data_loader = self.get_explorer_data_loader(explorer_id)
+        epoch = 0
         while self.global_count.value() <= self.cfg.T_max + self.cfg.mem_size:
-            dloader = iter(DataLoader(self.train_dset, batch_size=self.cfg.batch_size, shuffle=True, pin_memory=True,
-                                      num_workers=0))
-            for iteration in range((len(self.train_dset) // self.cfg.batch_size) * self.cfg.data_update_frequency):
+            try:
+                self.epoch_barrier.wait()
+            except threading.BrokenBarrierError:
+                # another explorer has stopped
+                break
+            data_loader.batch_sampler.set_epoch(epoch)
+            epoch += 1
+            dloader = iter(data_loader)
+            if self.cfg.get("prefetch_env_data", False):
+                dloader = EnvDataPrefetcher(env.envs, dloader, self.device)
+            for iteration in range(len(data_loader) // len(env) * self.cfg.data_update_frequency):
                 if iteration % self.cfg.data_update_frequency == 0:
-                    update_env_data(env, dloader, self.train_dset, self.device,
-                                    with_gt_edges="sub_graph_dice" in self.cfg.reward_function)
+                    for _env in env.envs:
+                        update_env_data(_env, dloader, self.device,
+                                        with_gt_edges="sub_graph_dice" in self.cfg.reward_function)
                 env.reset()
-                state = env.get_state()
+                states = env.get_states()
 
                 if not self.memory.is_full():
-                    action = torch.rand((env.edge_ids.shape[-1], 1), device=self.device)
+                    action = torch.rand((env.n_actions, 1), device=self.device)
                 else:
                     self.model_mtx.acquire()
                     try:
-                        distr, _, action, _, _ = self.forwarder.forward(self.model, state, State, self.device,
-                                                                        grad=False)
+                        action = torch.cat([self.forwarder.forward(self.model, state, State, self.device, grad=False)[2]
+                                            for state in env.get_collated_states()], 0)
                     finally:
                         self.model_mtx.release()
 
-                reward = env.execute_action(action, tau=max(0, tau))
-                self.memory.push(state_to_cpu(state, State), action, reward)
+                rewards = env.execute_action(action, tau=max(0, tau))
+                for _state, _action, reward in zip(states, env.split_actions(action), rewards):
+                    self.memory.push(state_to_cpu(_state, State), _action, reward)
                 if self.global_count.value() > self.cfg.T_max + self.cfg.mem_size:
                     break
+            if isinstance(dloader, EnvDataPrefetcher):
+                dloader.close()
+        # explorers that wait for the next epoch must not wait for this one
+        self.epoch_barrier.abort()
+        env.close()
         return
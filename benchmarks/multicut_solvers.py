@@ -0,0 +1,60 @@
+import argparse
+import os
+import time
+from glob import glob
+import h5py
+import numpy as np
+from elf.segmentation.multicut import transform_probabilities_to_costs
+from utils.graphs import graph_from_uv_ids
+from utils.multicut_solvers import MULTICUT_SOLVERS, solve_multicut, multicut_energy
+
+
+def load_problems(data_dir, n_files=None, p_min=0.001):
+    """
+    multicut problems from the superpixel graphs of preprocessed files (see data.preprocess). The boundary
+    probabilities are the mean affinities along the edges, normalized per graph like in the environment.
+    """
+    problems = []
+    for name in sorted(glob(os.path.join(data_dir, "*.h5")))[:n_files]:
+        with h5py.File(name, "r") as f:
+            edges, affinities = f["edges"][:], f["edge_feat"][1]
+            n_nodes = int(f["superpixels"][:].max()) + 1
+        probs = (affinities - affinities.min()) / max(affinities.max() - affinities.min(), 1e-10)
+        costs = transform_probabilities_to_costs(np.clip(probs, p_min, 1 - p_min))
+        problems.append((os.path.basename(name), graph_from_uv_ids(edges.T, n_nodes), costs))
+    return problems
+
+
+def bench(problems, solver, time_limit, n_threads):
+    """:return: energy and runtime in seconds of every problem"""
+    energies, runtimes = [], []
+    for _, graph, costs in problems:
+        start = time.perf_counter()
+        node_labels = solve_multicut(graph, costs, solver, time_limit, n_threads)
+        runtimes.append(time.perf_counter() - start)
+        energies.append(multicut_energy(graph, costs, node_labels))
+    return np.array(energies), np.array(runtimes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares energy and runtime of the multicut solvers on the "
+                                                 "superpixel graphs of a preprocessed dataset")
+    parser.add_argument("data_dir", help="directory with h5 files as written by data.preprocess")
+    parser.add_argument("--solvers", nargs="+", default=list(MULTICUT_SOLVERS.keys()),
+                        choices=list(MULTICUT_SOLVERS.keys()))
+    parser.add_argument("--time_limit", type=float, default=None, help="wall clock budget per solve in seconds")
+    parser.add_argument("--n_threads", type=int, default=1)
+    parser.add_argument("--n_files", type=int, default=None)
+    args = parser.parse_args()
+
+    problems = load_problems(args.data_dir, args.n_files)
+    print(f"{len(problems)} graphs, {np.mean([graph.numberOfEdges for _, graph, _ in problems]):.0f} edges on average")
+    results = {solver: bench(problems, solver, args.time_limit, args.n_threads) for solver in args.solvers}
+
+    # the gap is relative to the lowest energy any solver found for a graph
+    best = np.min([energies for energies, _ in results.values()], 0)
+    print(f"{'solver':<16} {'mean energy':>14} {'mean gap':>10} {'mean runtime':>14} {'max runtime':>13}")
+    for solver, (energies, runtimes) in results.items():
+        gap = np.mean((energies - best) / np.maximum(np.abs(best), 1e-10))
+        print(f"{solver:<16} {energies.mean():>14.2f} {gap:>10.2%} {runtimes.mean() * 1e3:>11.2f} ms "
+              f"{runtimes.max() * 1e3:>10.2f} ms")
@@ -0,0 +1,59 @@
+import argparse
+import timeit
+import torch
+from utils.graphs import squeeze_repr
+
+
+def squeeze_repr_broadcast(nodes, edges, seg):
+    """the previous implementation, which compares every pixel and edge with every node"""
+    _nodes = torch.arange(0, len(nodes), device=nodes.device)
+    indices = torch.where(edges.unsqueeze(0) == nodes.unsqueeze(-1).unsqueeze(-1))
+    edges[indices[1], indices[2]] = _nodes[indices[0]]
+    indices = torch.where(seg.unsqueeze(0) == nodes.unsqueeze(-1).unsqueeze(-1))
+    seg[indices[1], indices[2]] = _nodes[indices[0]].float().type(seg.dtype)
+
+
+def make_data(n_nodes, size, device):
+    """a patch of size x size superpixels whose ids are a random subset of a larger id range"""
+    n_per_dim = int(n_nodes ** 0.5)
+    grid = torch.arange(size, device=device) * n_per_dim // size
+    seg = grid[:, None] * n_per_dim + grid[None]
+    ids = torch.randperm(10 * n_nodes, device=device)[:n_per_dim ** 2]
+    seg = ids[seg]
+    edges = torch.cat([torch.stack([seg[:, :-1], seg[:, 1:]]).flatten(1), torch.stack([seg[:-1], seg[1:]]).flatten(1)], 1)
+    edges = torch.unique(edges[:, edges[0] != edges[1]], dim=1)
+    return torch.unique(seg), edges, seg
+
+
+def bench(fn, nodes, edges, seg, n_runs, device):
+    def run():
+        fn(nodes, edges.clone(), seg.clone())
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    run()
+    return min(timeit.repeat(run, number=1, repeat=n_runs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares squeeze_repr with the broadcasting implementation")
+    parser.add_argument("--n_nodes", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--n_runs", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--skip_broadcast", action="store_true", help="do not run the memory hungry implementation")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    nodes, edges, seg = make_data(args.n_nodes, args.size, device)
+    expected_edges, expected_seg = edges.clone(), seg.clone()
+    squeeze_repr_broadcast(nodes, expected_edges, expected_seg)
+    new_edges, new_seg = squeeze_repr(nodes, edges, seg, inplace=False)
+    assert torch.equal(new_edges, expected_edges) and torch.equal(new_seg, expected_seg)
+
+    print(f"{len(nodes)} nodes, {edges.shape[1]} edges, {args.size}x{args.size} patch on {device}")
+    print(f"squeeze_repr inplace:     {bench(squeeze_repr, nodes, edges, seg, args.n_runs, device) * 1e3:.2f} ms")
+    out_of_place = lambda n, e, s: squeeze_repr(n, e, s, inplace=False)
+    print(f"squeeze_repr out of place: {bench(out_of_place, nodes, edges, seg, args.n_runs, device) * 1e3:.2f} ms")
+    if not args.skip_broadcast:
+        print(f"broadcast:                 "
+              f"{bench(squeeze_repr_broadcast, nodes, edges, seg, args.n_runs, device) * 1e3:.2f} ms")
@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import OrderedDict
+import h5py
+from utils.fork_safe import ForkSafe
+
+
+class H5HandlePool(ForkSafe):
+    """
+    Bounded pool of open read-only h5 file handles with LRU eviction.
+    Handles are only valid in the process that opened them. After a fork (e.g. in DataLoader workers) the pool
+    forgets the inherited handles without closing them, and every process opens its own ones.
+    """
+    _init_args = ("max_open", "mode")
+
+    def __init__(self, max_open=16, mode='r'):
+        super(H5HandlePool, self).__init__()
+        assert max_open > 0
+        self.max_open = max_open
+        self.mode = mode
+        self._handles = OrderedDict()
+        self._mtx = threading.Lock()
+
+    def get(self, file_name):
+        self._check_pid()
+        with self._mtx:
+            handle = self._handles.get(file_name)
+            if handle is not None and handle.id.valid:
+                self._handles.move_to_end(file_name)
+                return handle
+            handle = h5py.File(file_name, self.mode)
+            self._handles[file_name] = handle
+            while len(self._handles) > self.max_open:
+                # only drop the reference, another thread might still read from the evicted file. h5py closes the
+                # file as soon as the last reference is gone
+                self._handles.popitem(last=False)
+            return handle
+
+    def close(self, file_name):
+        self._check_pid()
+        with self._mtx:
+            handle = self._handles.pop(file_name, None)
+            if handle is not None:
+                handle.close()
+
+    def clear(self):
+        self._check_pid()
+        with self._mtx:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __del__(self):
+        try:
+            if self._pid == os.getpid():
+                for handle in self._handles.values():
+                    handle.close()
+        except Exception:
+            pass
@@ -0,0 +1,75 @@
+import numpy as np
+from elf.segmentation.features import compute_rag
+
+INDEX_GROUP = "patch_graph_index"
+
+
+def get_index_group_name(pm):
+    return INDEX_GROUP + "/" + pm.index_key
+
+
+def compute_patch_graph_index(edges, sp_seg, pm):
+    """
+    computes for every patch of pm the superpixels that are visible in it and the edges between them
+    :param edges: np.ndarray of shape (2, E), the rag of the whole image
+    :param sp_seg: np.ndarray of shape (H, W), superpixels of the whole image
+    :param pm: patch manager
+    :return: dict of flat arrays: nodes, edge_ids and the uv ids of the patch rag (in relabeled node ids) per patch
+             concatenated plus their offsets
+    """
+    nodes, edge_ids, rag_uv_ids = [], [], []
+    for patch_idx in range(int(np.prod(pm.n_patch_per_dim))):
+        patch = pm.read_patch(sp_seg, patch_idx)
+        _nodes = np.unique(patch)
+        visible = np.isin(edges[0], _nodes) & np.isin(edges[1], _nodes)
+        nodes.append(_nodes.astype(np.int64))
+        edge_ids.append(np.nonzero(visible)[0].astype(np.int64))
+        rag_uv_ids.append(compute_rag(np.searchsorted(_nodes, patch).astype(np.uint32)).uvIds().astype(np.int64))
+
+    return {"nodes": np.concatenate(nodes),
+            "node_offsets": np.cumsum([0] + [len(n) for n in nodes]).astype(np.int64),
+            "edge_ids": np.concatenate(edge_ids),
+            "edge_offsets": np.cumsum([0] + [len(e) for e in edge_ids]).astype(np.int64),
+            "rag_uv_ids": np.concatenate(rag_uv_ids).reshape(-1, 2),
+            "rag_offsets": np.cumsum([0] + [len(uv) for uv in rag_uv_ids]).astype(np.int64)}
+
+
+def write_patch_graph_index(file, keys, pm, overwrite=False):
+    """writes the patch graph index for pm into an h5 file opened in write mode. Returns True if it was written"""
+    group_name = get_index_group_name(pm)
+    if group_name in file:
+        if not overwrite:
+            return False
+        del file[group_name]
+    index = compute_patch_graph_index(file[keys.edges][:], file[keys.superpixels][:], pm)
+    group = file.create_group(group_name)
+    for name, data in index.items():
+        group.create_dataset(name=name, data=data)
+    return True
+
+
+def has_patch_graph_index(file, pm):
+    return get_index_group_name(pm) in file
+
+
+def read_patch_graph_index(file, pm, patch_idx):
+    """
+    :return: the sorted superpixel ids visible in the patch (their position is the new node id) and the indices of the
+             edges in the full rag that connect two of them
+    """
+    group = file[get_index_group_name(pm)]
+    n_start, n_stop = group["node_offsets"][patch_idx:patch_idx + 2]
+    e_start, e_stop = group["edge_offsets"][patch_idx:patch_idx + 2]
+    return group["nodes"][n_start:n_stop], group["edge_ids"][e_start:e_stop]
+
+
+def read_patch_rag(file, pm, patch_idx):
+    """
+    :return: uv ids and number of nodes of the rag of the relabeled patch or None if the index does not store rags
+    """
+    group = file[get_index_group_name(pm)]
+    if "rag_uv_ids" not in group:
+        return None
+    n_start, n_stop = group["node_offsets"][patch_idx:patch_idx + 2]
+    r_start, r_stop = group["rag_offsets"][patch_idx:patch_idx + 2]
+    return group["rag_uv_ids"][r_start:r_stop], int(n_stop - n_start)
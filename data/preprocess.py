@@ -0,0 +1,102 @@
+import os
+import argparse
+from glob import glob
+from multiprocessing import Pool
+import h5py
+import numpy as np
+import torch
+from utils.affinities import get_naive_affinities, get_edge_features_1d
+from utils.graphs import run_watershed, get_position_mass_in_rag
+from utils.relabel import relabel_consecutive, majority_projection
+
+OFFSETS = [[1, 0], [0, 1], [2, 0], [0, 2], [4, 0], [0, 4], [16, 0], [0, 16]]
+
+
+def compute_graph_data(raw, gt=None, offsets=OFFSETS, min_size=None):
+    """
+    computes superpixels and their graph with handcrafted features for one image
+    :param raw: np.ndarray of shape (C, H, W) or (H, W)
+    :param gt: optional np.ndarray of shape (H, W)
+    :return: dict with superpixels, edges, edge_feat, node_feat and gt_edge_weights if gt is given, laid out as
+             expected by SpgDset
+    """
+    if raw.ndim == 2:
+        raw = raw[None]
+    # the affinities are distances of neighboring pixel intensities, high values mark boundaries
+    affinities = get_naive_affinities(np.moveaxis(raw, 0, -1).astype(np.float32), offsets)
+    hmap = affinities[:2].mean(0)
+    # run_watershed seeds at the maxima of its input, which have to be the superpixel centers, not the boundaries
+    sp_seg = relabel_consecutive(run_watershed(1 - hmap, min_size=min_size)).astype(np.int64)
+
+    aff_feat, uv_ids = get_edge_features_1d(sp_seg, offsets, affinities)
+    edges = uv_ids.astype(np.int64).T
+    edge_angles, node_feat = get_position_mass_in_rag(torch.from_numpy(edges), torch.from_numpy(sp_seg))
+    edge_feat = np.concatenate([edge_angles.numpy()[:, None], aff_feat[:, :2]], 1).astype(np.float32).T
+
+    data = {"superpixels": sp_seg, "edges": edges, "edge_feat": edge_feat,
+            "node_feat": node_feat.numpy().astype(np.float32)}
+    if gt is not None:
+        _, sp_gt = majority_projection(sp_seg, gt)
+        data["gt_edge_weights"] = (sp_gt[edges[0]] != sp_gt[edges[1]]).astype(np.float32)
+    return data
+
+
+def preprocess_file(in_name, out_name, raw_key="raw", gt_key="gt", offsets=OFFSETS, min_size=None):
+    """writes raw, gt and the graph data of one file. The file is first written to a temporary name and then moved"""
+    with h5py.File(in_name, "r") as f:
+        raw = f[raw_key][:]
+        gt = f[gt_key][:] if gt_key in f else None
+    if raw.ndim == 2:
+        # SpgDset and the models expect raw data with a channel axis
+        raw = raw[None]
+    data = compute_graph_data(raw, gt, offsets, min_size)
+
+    tmp_name = out_name + ".tmp"
+    with h5py.File(tmp_name, "w") as f:
+        f.create_dataset(name="raw", data=raw)
+        if gt is not None:
+            f.create_dataset(name="gt", data=gt)
+        for key, value in data.items():
+            f.create_dataset(name=key, data=value)
+    os.replace(tmp_name, out_name)
+    return out_name
+
+
+def _preprocess_job(args):
+    return preprocess_file(*args)
+
+
+def preprocess_dir(in_dir, out_dir, raw_key="raw", gt_key="gt", offsets=OFFSETS, min_size=None, n_workers=1,
+                   overwrite=False):
+    """
+    preprocesses all h5 files in in_dir with a pool of n_workers processes. Files that already exist in out_dir are
+    skipped unless overwrite is set, so an interrupted run can simply be restarted.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for in_name in sorted(glob(os.path.join(in_dir, "*.h5"))):
+        out_name = os.path.join(out_dir, os.path.split(in_name)[1])
+        if overwrite or not os.path.exists(out_name):
+            jobs.append((in_name, out_name, raw_key, gt_key, offsets, min_size))
+    print(f"preprocessing {len(jobs)} files")
+    if n_workers <= 1:
+        for i, job in enumerate(jobs):
+            print(f"{i + 1}/{len(jobs)}: {_preprocess_job(job)}")
+        return
+    with Pool(n_workers) as pool:
+        for i, out_name in enumerate(pool.imap_unordered(_preprocess_job, jobs)):
+            print(f"{i + 1}/{len(jobs)}: {out_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compute superpixels, graphs and features for SpgDset")
+    parser.add_argument("in_dir", help="directory containing h5 files with raw data and optionally gt")
+    parser.add_argument("out_dir", help="directory for the preprocessed h5 files")
+    parser.add_argument("--raw_key", default="raw")
+    parser.add_argument("--gt_key", default="gt")
+    parser.add_argument("--min_size", type=int, default=None, help="minimum superpixel size")
+    parser.add_argument("--n_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true", help="recompute files that already exist in out_dir")
+    args = parser.parse_args()
+    preprocess_dir(args.in_dir, args.out_dir, args.raw_key, args.gt_key, min_size=args.min_size,
+                   n_workers=args.n_workers, overwrite=args.overwrite)
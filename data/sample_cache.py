@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from utils.fork_safe import ForkSafe
+
+
+def get_n_bytes(data):
+    """recursively sums the memory of all tensors and arrays in data"""
+    if torch.is_tensor(data):
+        return data.element_size() * data.nelement()
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, (list, tuple)):
+        return sum(get_n_bytes(d) for d in data)
+    if isinstance(data, dict):
+        return sum(get_n_bytes(d) for d in data.values())
+    return 0
+
+
+class SampleCache(ForkSafe):
+    """
+    thread safe in memory cache for decoded samples that is bounded by a byte budget.
+    Entries are evicted by least recent ("lru") or least frequent ("lfu") use. Each process has its own cache, so
+    with DataLoader workers every worker caches the samples it loads. After a fork the cache starts empty with new
+    counters, the statistics of the workers are not visible in the main process.
+    """
+    _init_args = ("max_bytes", "policy")
+
+    def __init__(self, max_bytes, policy="lru"):
+        super(SampleCache, self).__init__()
+        assert policy in ("lru", "lfu"), f"unknown eviction policy {policy}"
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._data = {}  # key -> [value, n_bytes, n_uses]
+        # n_uses -> keys ordered by last use, lru keeps all keys in bucket 0. The next victim is the first key of
+        # the bucket with the fewest uses, which makes every get, put and eviction O(1)
+        self._buckets = {}
+        self._min_uses = 0
+        self._mtx = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _bucket_id(self, n_uses):
+        return n_uses if self.policy == "lfu" else 0
+
+    def _link(self, key, n_uses):
+        bucket_id = self._bucket_id(n_uses)
+        self._buckets.setdefault(bucket_id, OrderedDict())[key] = None
+        if len(self._data) == 1 or bucket_id < self._min_uses:
+            self._min_uses = bucket_id
+
+    def _unlink(self, key, n_uses):
+        bucket_id = self._bucket_id(n_uses)
+        bucket = self._buckets[bucket_id]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self._buckets[bucket_id]
+            if bucket_id == self._min_uses and len(self._buckets) > 0:
+                # a get moves its key up by one bucket, so usually the next bucket is the new minimum
+                self._min_uses = bucket_id + 1 if bucket_id + 1 in self._buckets else min(self._buckets)
+
+    def get(self, key):
+        self._check_pid()
+        with self._mtx:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._unlink(key, entry[2])
+            entry[2] += 1
+            self._link(key, entry[2])
+            return entry[0]
+
+    def put(self, key, value):
+        n_bytes = get_n_bytes(value)
+        if n_bytes > self.max_bytes:
+            return
+        self._check_pid()
+        with self._mtx:
+            if key in self._data:
+                self._pop(key)
+            while self.n_bytes + n_bytes > self.max_bytes:
+                # least recently used key of the least frequently used bucket
+                self._pop(next(iter(self._buckets[self._min_uses])))
+            self._data[key] = [value, n_bytes, 1]
+            self._link(key, 1)
+            self.n_bytes += n_bytes
+
+    def _pop(self, key):
+        entry = self._data.pop(key)
+        self._unlink(key, entry[2])
+        self.n_bytes -= entry[1]
+
+    @property
+    def hit_rate(self):
+        n_requests = self.hits + self.misses
+        return self.hits / n_requests if n_requests > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "n_bytes": self.n_bytes,
+                "n_entries": len(self._data)}
+
+    def clear(self):
+        self._check_pid()
+        with self._mtx:
+            self._data = {}
+            self._buckets = {}
+            self.n_bytes = 0
@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ShapeBucketBatchSampler(Sampler):
+    """
+    batch sampler that only puts samples of the same bucket (e.g. patch shape, see SpgDset.get_bucket_ids) into one
+    batch, such that images of different shapes can be stacked without padding.
+    With world_size > 1 the batches are sharded: every rank (explorer thread, process or host) iterates a disjoint
+    subset of them. All ranks have to use the same seed and epoch, the shuffling is then identical on each of them.
+    """
+
+    def __init__(self, bucket_ids, batch_size, shuffle=True, drop_last=False, seed=0, rank=0, world_size=1):
+        assert 0 <= rank < world_size
+        self.bucket_ids = np.asarray(bucket_ids)
+        self.buckets = [np.nonzero(self.bucket_ids == b)[0] for b in np.unique(self.bucket_ids)]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """the batches are reshuffled for every epoch"""
+        self.epoch = epoch
+
+    def _n_batches(self, n_samples):
+        if self.drop_last:
+            return n_samples // self.batch_size
+        return (n_samples + self.batch_size - 1) // self.batch_size
+
+    def __len__(self):
+        n_batches = sum(self._n_batches(len(bucket)) for bucket in self.buckets)
+        return len(range(self.rank, n_batches, self.world_size))
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket), generator=generator).numpy()]
+            for i in range(self._n_batches(len(bucket))):
+                batches.append(bucket[i * self.batch_size:(i + 1) * self.batch_size].tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(batches[self.rank::self.world_size])
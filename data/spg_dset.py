@@ -2,135 +2,202 @@ import torch
 import h5py
 import os
 from glob import glob
+from data.h5_pool import H5HandlePool
 from utils.patch_manager import StridedRollingPatches2D, StridedPatches2D, NoPatches2D
+from data.patch_graph_index import write_patch_graph_index, has_patch_graph_index, read_patch_graph_index, \
+    read_patch_rag
 from utils.graphs import squeeze_repr
+from utils.lru_cache import LruCache
+from data.sample_cache import SampleCache
+from utils.relabel import relabel_consecutive
 import torch.utils.data as torch_data
+from torch.utils.data.dataloader import default_collate
+from elf.segmentation.features import compute_rag
 import numpy as np
 
 
 class SpgDset(torch_data.Dataset):
-    def __init__(self, file_dir, patch_mngr, keys, n_edges_min=0):
-        """ dataset for loading images (raw, gt, superpixel segs) and according rags"""
+    # subclasses that read from other stores than h5 files set this to False and get no pool of h5 handles
+    reads_h5 = True
+
+    def __init__(self, file_dir, patch_mngr, keys, n_edges_min=0, max_open_files=16, rag_cache_size=1024,
+                 sample_cache_bytes=0, sample_cache_policy="lru"):
+        """ dataset for loading images (raw, gt, superpixel segs) and according rags.
+        If sample_cache_bytes > 0, decoded samples are kept in memory up to that budget"""
         # self.transform = torchvision.transforms.Normalize(0, 1, inplace=False)
         self.keys = keys
-        self.file_names = sorted(glob(os.path.join(file_dir, "*.h5")))
+        self.file_names = self.find_files(file_dir)
         self.reorder_sp = patch_mngr.reorder_sp
         self.n_edges_min = n_edges_min
-        example_file = h5py.File(self.file_names[0], 'r')
-        shape = example_file[keys.raw][:].shape[-2:]
-        if patch_mngr.name == "rotated":
-            self.pm = StridedRollingPatches2D(patch_mngr.patch_stride, patch_mngr.patch_shape, shape)
-        elif patch_mngr.name == "no_cross":
-            self.pm = StridedPatches2D(patch_mngr.patch_stride, patch_mngr.patch_shape, shape)
-        else:
-            self.pm = NoPatches2D()
-        self.length = len(self.file_names) * np.prod(self.pm.n_patch_per_dim)
+        self.h5_pool = H5HandlePool(max_open_files) if self.reads_h5 else None
+        self.rag_cache = LruCache(rag_cache_size)
+        self.sample_cache = SampleCache(sample_cache_bytes, sample_cache_policy) if sample_cache_bytes > 0 else None
+        self.patch_mngr = patch_mngr
+        # images may differ in shape, there is one patch manager per distinct shape
+        self.shapes = [tuple(self.open_file(i)[keys.raw].shape[-2:]) for i in range(len(self.file_names))]
+        self.pms = {shape: self._make_patch_manager(shape) for shape in set(self.shapes)}
+        n_patches = [int(np.prod(self.pms[shape].n_patch_per_dim)) for shape in self.shapes]
+        self.patch_offsets = np.cumsum([0] + n_patches)
+        self.length = int(self.patch_offsets[-1])
 
     def __len__(self):
         return self.length
 
-    def __getitem__(self, idx):
-        img_idx = idx // np.prod(self.pm.n_patch_per_dim)
-        patch_idx = idx % np.prod(self.pm.n_patch_per_dim)
-        file = h5py.File(self.file_names[img_idx], 'r')
+    def _make_patch_manager(self, shape):
+        if self.patch_mngr.name == "rotated":
+            return StridedRollingPatches2D(self.patch_mngr.patch_stride, self.patch_mngr.patch_shape, shape)
+        elif self.patch_mngr.name == "no_cross":
+            return StridedPatches2D(self.patch_mngr.patch_stride, self.patch_mngr.patch_shape, shape)
+        return NoPatches2D()
+
+    def get_pm(self, img_idx):
+        return self.pms[self.shapes[int(img_idx)]]
+
+    def locate(self, idx):
+        """maps a global sample index to (file index, patch index)"""
+        img_idx = int(np.searchsorted(self.patch_offsets, idx, side="right")) - 1
+        return img_idx, int(idx - self.patch_offsets[img_idx])
+
+    def get_patch_shape(self, img_idx):
+        pm = self.get_pm(img_idx)
+        return self.shapes[int(img_idx)] if isinstance(pm, NoPatches2D) else tuple(int(s) for s in pm.patch_shape)
 
-        raw = torch.from_numpy(file[self.keys.raw][:])
-        sp_seg = torch.from_numpy(file[self.keys.superpixels][:].astype(np.float))
+    def get_bucket_ids(self):
+        """returns for every sample the id of its patch shape, only samples with the same id can be batched"""
+        patch_shapes = [self.get_patch_shape(i) for i in range(len(self.file_names))]
+        bucket_of_shape = {shape: i for i, shape in enumerate(sorted(set(patch_shapes)))}
+        return np.repeat([bucket_of_shape[shape] for shape in patch_shapes], np.diff(self.patch_offsets))
+
+    def find_files(self, file_dir):
+        return sorted(glob(os.path.join(file_dir, "*.h5")))
+
+    def open_file(self, img_idx):
+        """returns a read only h5 like object that maps dataset keys to array likes"""
+        return self.h5_pool.get(self.file_names[int(img_idx)])
+
+    def __getitem__(self, idx):
+        """
+        returns the image data together with the graph of the patch, such that all preprocessing can happen in
+        DataLoader workers. The graph data can not be batched, use collate_graph_samples as collate_fn.
+        """
+        if self.sample_cache is not None:
+            sample = self.sample_cache.get(int(idx))
+            if sample is not None:
+                return _clone_sample(sample)
+        raw, gt, sp_seg, indices = self.load_images(idx)
+        edges, gt_edge_weights, edge_feat, node_feat = self.get_graph(indices[0], indices[1], sp_seg)
+        rag = self.get_rag(indices[0], indices[1], sp_seg)
+        sample = raw, gt, sp_seg, indices, edges, gt_edge_weights, edge_feat, node_feat, rag
+        if self.sample_cache is not None:
+            self.sample_cache.put(int(idx), sample)
+            # consumers modify the edges in place, so the cached tensors are never handed out
+            return _clone_sample(sample)
+        return sample
+
+    def load_images(self, idx):
+        img_idx, patch_idx = self.locate(idx)
+        pm = self.get_pm(img_idx)
+        file = self.open_file(img_idx)
+
+        # only read the patch window from disk instead of loading and rolling the whole image
+        raw = torch.from_numpy(pm.read_patch(file[self.keys.raw], patch_idx)).float()
+        # superpixels are relabeled in place later on, so they must not be a view into memory mapped data
+        sp_seg = torch.from_numpy(np.array(pm.read_patch(file[self.keys.superpixels], patch_idx), dtype=np.int64))
         if "gt" in self.keys:  # in case we have ground truth
-            gt = torch.from_numpy(file[self.keys.gt][:].astype(np.float))
+            gt = torch.from_numpy(pm.read_patch(file[self.keys.gt], patch_idx, dtype=np.int64))
         else:
             gt = torch.zeros_like(sp_seg)
 
-        all = torch.cat([raw, gt[None], sp_seg[None]], 0)
-        patch = self.pm.get_patch(all, patch_idx)
-
-        sp_seg = patch[-1]
-        gt = patch[-2]
-        raw = patch[:-2].float()
-
         if not self.reorder_sp:
-            return raw, gt.long(), sp_seg.long(), torch.tensor([img_idx])
+            return raw, gt.long(), sp_seg.long(), torch.tensor([img_idx, patch_idx])
 
         # relabel to consecutive ints starting at 0
-        mask = sp_seg[None] == torch.unique(sp_seg)[:, None, None]
-        sp_seg = (mask * (torch.arange(len(torch.unique(sp_seg)), device=sp_seg.device)[:, None, None] + 1)).sum(0) - 1
-
-        mask = gt[None] == torch.unique(gt)[:, None, None]
-        gt = (mask * (torch.arange(len(torch.unique(gt)), device=gt.device)[:, None, None] + 1)).sum(0) - 1
-
-        return raw, gt.long()[None], sp_seg.long()[None], torch.tensor([img_idx])
+        sp_seg = relabel_consecutive(sp_seg)
+        gt = relabel_consecutive(gt)
+
+        return raw, gt.long()[None], sp_seg.long()[None], torch.tensor([img_idx, patch_idx])
+
+    def build_patch_graph_index(self, overwrite=False):
+        """
+        stores for each patch of the patch manager the visible nodes and edges in the files,
+        such that get_graphs does not need to search them on every call
+        """
+        assert self.reads_h5, "the patch graph index is built on the h5 files, before they are converted"
+        self.h5_pool.clear()
+        for img_idx, file_name in enumerate(self.file_names):
+            with h5py.File(file_name, 'r+') as file:
+                write_patch_graph_index(file, self.keys, self.get_pm(img_idx), overwrite)
+
+    def get_graph(self, img_idx, patch_idx, patch, device="cpu"):
+        """
+        loads the part of the graph that is visible in patch. The superpixel ids in patch are relabeled in place to
+        match the nodes of the returned edges.
+        """
+        file = self.open_file(img_idx)
+        pm = self.get_pm(img_idx)
+        es = torch.from_numpy(file[self.keys.edges][:]).to(device)
+        # get only the part of the graph that is visible in the patch
+        if not self.reorder_sp and has_patch_graph_index(file, pm):
+            nodes, iters = read_patch_graph_index(file, pm, int(patch_idx))
+            nodes, iters = torch.from_numpy(nodes).to(device), torch.from_numpy(iters).to(device)
+            # searchsorted needs the same dtype for the nodes and the values, the edges might be stored as int32
+            es = torch.searchsorted(nodes, es[:, iters].to(nodes.dtype).contiguous())
+            patch[...] = torch.searchsorted(nodes, patch.to(nodes.dtype).contiguous()).type(patch.dtype)
+        else:
+            nodes = torch.unique(patch)
+            iters = (es.unsqueeze(0) == nodes[:, None, None]).float().sum(0).sum(0) >= 2
+            es = es[:, iters]
+            squeeze_repr(nodes, es, patch.squeeze(0))
+
+        gt_edge_weights, edge_feat, node_feat = None, None, None
+        if "gt_edge_weights" in self.keys:
+            gt_edge_weights = torch.from_numpy(file[self.keys.gt_edge_weights][:]).to(device)[iters]
+        if "edge_feat" in self.keys:
+            edge_feat = torch.from_numpy(file[self.keys.edge_feat][:]).to(device)[:, iters].permute((1, 0))
+        if "node_feat" in self.keys:
+            node_feat = torch.from_numpy(file[self.keys.node_feat][:]).to(device)[:, nodes].permute((1, 0))
+
+        assert es.shape[1] >= self.n_edges_min, "One of the graphs was smaller than our min size given by largest subgraph size"
+        return es, gt_edge_weights, edge_feat, node_feat
+
+    def get_rag(self, img_idx, patch_idx, sp_seg):
+        """
+        returns the rag of the (relabeled) superpixels of a patch as uv ids and number of nodes. Rags are taken from the
+        patch graph index if it stores them and otherwise computed once per (file, patch) and kept in an lru cache.
+        """
+        key = (int(img_idx), int(patch_idx))
+        rag = self.rag_cache.get(key)
+        if rag is not None:
+            return rag
+        file, pm = self.open_file(key[0]), self.get_pm(key[0])
+        if not self.reorder_sp and has_patch_graph_index(file, pm):
+            rag = read_patch_rag(file, pm, key[1])
+        if rag is None:
+            rag = compute_rag(sp_seg.squeeze(0).numpy())
+            rag = (rag.uvIds(), rag.numberOfNodes)
+        self.rag_cache.put(key, rag)
+        return rag
 
     def get_graphs(self, indices, patches, device="cpu"):
         # we get the graph data separately because it cannot be batched
         edges,  gt_edge_weights, edge_feat, node_feat = [], [], [], []
         for i, patch in zip(indices, patches):
-            nodes = torch.unique(patch).unsqueeze(-1).unsqueeze(-1)
-            file = h5py.File(self.file_names[i], 'r')
-            # get only the part of the graph that is visible in the patch
-            es = torch.from_numpy(file[self.keys.edges][:]).to(device)
-            iters = (es.unsqueeze(0) == nodes).float().sum(0).sum(0) >= 2
-            es = es[:, iters]
-            squeeze_repr(nodes.squeeze(-1).squeeze(-1), es, patch.squeeze(0))
-
-            edges.append(es)
-            if "gt_edge_weights" in self.keys:
-                gt_edge_weights.append(torch.from_numpy(file[self.keys.gt_edge_weights][:]).to(device)[iters])
-            else:
-                gt_edge_weights = None
-            if "edge_feat" in self.keys:
-                edge_feat.append(torch.from_numpy(file[self.keys.edge_feat][:]).to(device)[:, iters].permute((1, 0)))
-            else:
-                edge_feat = None
-            if "node_feat" in self.keys:
-                node_feat.append(torch.from_numpy(file[self.keys.node_feat][:]).to(device)[:, nodes.squeeze()].permute((1, 0)))
-            else:
-                node_feat = None
-
-            assert es.shape[1] >= self.n_edges_min, "One of the graphs was smaller than our min size given by largest subgraph size"
-        return edges, gt_edge_weights, edge_feat, node_feat
-
-
-if __name__=="__main__":
-    from utils.graphs import get_position_mass_in_rag
-    dir = "/g/kreshuk/hilt/projects/data/color_circles/train"
-    newdir = "/g/kreshuk/hilt/projects/data/color_circles/all_in_one/train"
-    graph_file_names = sorted(glob(os.path.join(dir + "/graph_data", "*.h5")))
-
-    raw_n = "raw_4chnl"
-    gt_n = "gt"
-    node_labeling_n = "node_labeling"
-    gt_edge_weights_n = "gt_edge_weights"
-    edges_n = "edges"
-
-    for gfn in graph_file_names:
-        _, name = os.path.split(gfn)
-        name = name[6:]
-        pfn = os.path.join(dir, "pix_data", "pix_"+name)
-        pf = h5py.File(pfn, "r")
-        gf = h5py.File(gfn, "r")
-
-        newfile = h5py.File(os.path.join(newdir, name), "r+")
-
-        edge_features = torch.from_numpy(gf["edge_feat"][:])
-        # gt = pf[gt_n][:]
-        sp_seg = gf[node_labeling_n][:]
-        # gt_edges = gf[gt_edge_weights_n][:]
-        edges = gf[edges_n][:]
-
-        edge_angles, sp_feats = get_position_mass_in_rag(torch.from_numpy(edges), torch.from_numpy(sp_seg))
-
-        # newfile.create_dataset(name="raw", data=raw)
-        # newfile.create_dataset(name="superpixels", data=sp_seg)
-        # newfile.create_dataset(name="gt", data=gt)
-        # newfile.create_dataset(name="edges", data=edges)
-        # newfile.create_dataset(name="gt_edge_weights", data=gt_edges)
-
-        edge_features = torch.cat([edge_angles[:, None], edge_features[:, :2]], 1).float().permute((1, 0))
-
-        newfile.create_dataset(name="edge_feat", data=edge_features)
-        newfile.create_dataset(name="node_feat", data=sp_feats)
-
-        newfile.close()
-        pf.close()
-        gf.close()
+            graph = self.get_graph(i[0], i[-1], patch, device)
+            for data, item in zip((edges, gt_edge_weights, edge_feat, node_feat), graph):
+                data.append(item)
+        return edges, _none_if_missing(gt_edge_weights), _none_if_missing(edge_feat), _none_if_missing(node_feat)
+
+
+def _clone_sample(sample):
+    return tuple(item.clone() if torch.is_tensor(item) else item for item in sample)
+
+
+def _none_if_missing(items):
+    return None if any(item is None for item in items) else list(items)
+
 
+def collate_graph_samples(batch):
+    """collate_fn for SpgDset. Images are stacked, graph data is returned as lists (or None if not in the dataset)"""
+    raw, gt, sp_seg, indices, edges, gt_edge_weights, edge_feat, node_feat, rags = zip(*batch)
+    return (*default_collate(list(zip(raw, gt, sp_seg, indices))), list(edges), _none_if_missing(gt_edge_weights),
+            _none_if_missing(edge_feat), _none_if_missing(node_feat), list(rags))
@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+from glob import glob
+import h5py
+import numpy as np
+from data.spg_dset import SpgDset
+from utils.fork_safe import ForkSafe
+
+INDEX_NAME = "index.json"
+ALIGNMENT = 4096  # every array starts at a page boundary
+
+
+def _bin_name(path):
+    return path.replace("/", "__") + ".bin"
+
+
+def _list_datasets(file):
+    paths = []
+    file.visititems(lambda name, obj: paths.append(name) if isinstance(obj, h5py.Dataset) else None)
+    return paths
+
+
+def convert_h5_to_mmap(file_dir, out_dir):
+    """
+    packs all datasets of all h5 files in file_dir (raw, superpixels, gt, edges, gt_edge_weights, edge_feat,
+    node_feat and the patch graph index if present) into one flat binary file per dataset key. The offset, shape and
+    dtype of every array is stored in index.json.
+    """
+    file_names = sorted(glob(os.path.join(file_dir, "*.h5")))
+    assert len(file_names) > 0, f"no h5 files found in {file_dir}"
+    os.makedirs(out_dir, exist_ok=True)
+    index = {"names": [os.path.split(fn)[1] for fn in file_names], "datasets": {}}
+    bin_files = {}
+    try:
+        for i, file_name in enumerate(file_names):
+            with h5py.File(file_name, 'r') as file:
+                for path in _list_datasets(file):
+                    if path not in index["datasets"]:
+                        index["datasets"][path] = {"bin": _bin_name(path), "entries": [None] * len(file_names)}
+                        bin_files[path] = open(os.path.join(out_dir, _bin_name(path)), "wb")
+                    data = np.ascontiguousarray(file[path][:])
+                    bin_file = bin_files[path]
+                    offset = bin_file.tell()
+                    if offset % ALIGNMENT != 0:
+                        bin_file.write(b"\0" * (ALIGNMENT - offset % ALIGNMENT))
+                        offset = bin_file.tell()
+                    bin_file.write(data.tobytes())
+                    index["datasets"][path]["entries"][i] = [offset, list(data.shape), data.dtype.str]
+    finally:
+        for bin_file in bin_files.values():
+            bin_file.close()
+    tmp_name = os.path.join(out_dir, INDEX_NAME + ".tmp")
+    with open(tmp_name, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_name, os.path.join(out_dir, INDEX_NAME))
+
+
+class MmapGroup(object):
+    """h5 like read only view on the datasets of one file in a MmapStore"""
+
+    def __init__(self, store, file_idx, prefix=""):
+        self.store = store
+        self.file_idx = file_idx
+        self.prefix = prefix
+
+    def _path(self, key):
+        return self.prefix + key.strip("/")
+
+    def __contains__(self, key):
+        path = self._path(key)
+        return self.store.has_dataset(path, self.file_idx) or self.store.has_group(path, self.file_idx)
+
+    def __getitem__(self, key):
+        path = self._path(key)
+        if self.store.has_dataset(path, self.file_idx):
+            return self.store.get_array(path, self.file_idx)
+        if self.store.has_group(path, self.file_idx):
+            return MmapGroup(self.store, self.file_idx, path + "/")
+        raise KeyError(f"{path} not found in {self.store.names[self.file_idx]}")
+
+
+class MmapStore(ForkSafe):
+    """
+    memory maps the binary files written by convert_h5_to_mmap and hands out zero copy array views. Memmaps would be
+    pickled with all their data, so pickled stores map the files again.
+    """
+    _init_args = ("store_dir",)
+
+    def __init__(self, store_dir):
+        super(MmapStore, self).__init__()
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.names = index["names"]
+        self.datasets = index["datasets"]
+        self._maps = {}
+
+    def has_dataset(self, path, file_idx):
+        return path in self.datasets and self.datasets[path]["entries"][file_idx] is not None
+
+    def has_group(self, path, file_idx):
+        return any(p.startswith(path + "/") and self.has_dataset(p, file_idx) for p in self.datasets)
+
+    def get_array(self, path, file_idx):
+        offset, shape, dtype = self.datasets[path]["entries"][file_idx]
+        if path not in self._maps:
+            bin_name = os.path.join(self.store_dir, self.datasets[path]["bin"])
+            if os.path.getsize(bin_name) == 0:  # only empty arrays, which can not be mapped
+                return np.empty(shape, dtype=np.dtype(dtype))
+            # copy on write, so in place ops on the returned arrays never touch the files on disk
+            self._maps[path] = np.memmap(bin_name, mode="c")
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._maps[path], offset=offset)
+
+    def open(self, file_idx):
+        return MmapGroup(self, file_idx)
+
+
+class SpgMmapDset(SpgDset):
+    reads_h5 = False
+
+    def __init__(self, file_dir, patch_mngr, keys, n_edges_min=0, rag_cache_size=1024, sample_cache_bytes=0,
+                 sample_cache_policy="lru"):
+        """
+        same as SpgDset but reads from a directory written by convert_h5_to_mmap. Arrays are memory mapped,
+        so the os page cache is shared between all processes that read the same data. The store is read only, the
+        patch graph index is only available if it was built on the h5 files before they were converted.
+        """
+        self.store = MmapStore(file_dir)
+        super(SpgMmapDset, self).__init__(file_dir, patch_mngr, keys, n_edges_min, rag_cache_size=rag_cache_size,
+                                          sample_cache_bytes=sample_cache_bytes,
+                                          sample_cache_policy=sample_cache_policy)
+
+    def find_files(self, file_dir):
+        return list(self.store.names)
+
+    def open_file(self, img_idx):
+        return self.store.open(int(img_idx))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert a directory of SpgDset h5 files for SpgMmapDset")
+    parser.add_argument("file_dir", help="directory containing the h5 files")
+    parser.add_argument("out_dir", help="directory for the binary files and the index")
+    args = parser.parse_args()
+    convert_h5_to_mmap(args.file_dir, args.out_dir)
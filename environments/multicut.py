@@ -1,24 +1,27 @@
 import numpy as np
 import torch
 import collections
-import elf
+import itertools
 import wandb
 import matplotlib.pyplot as plt
 from elf.segmentation.multicut import multicut_kernighan_lin
-from elf.segmentation.features import project_node_labels_to_pixels
-from rag_utils import find_dense_subgraphs
 
 import rewards
-from utils.graphs import collate_edges, get_edge_indices
+from utils.batched_graph import BatchedGraph
+from utils.graphs import node_to_edge_actions
 from utils.general import random_label_cmap
+from utils.lru_cache import LruCache
+from utils.multicut_pool import MulticutPool, get_solver
+from utils.multicut_solvers import get_solver_kwargs
+from utils.subgraph_sampler import DenseSubgraphSampler, separate_subgraphs
 
-State = collections.namedtuple("State", ["raw", "sp_seg", "edge_ids", "edge_feat", "node_feat", "subgraph_indices",
+State = collections.namedtuple("State", ["raw", "sp_seg", "graph", "edge_feat", "node_feat", "subgraph_indices",
                                          "sep_subgraphs",  "gt_edge_weights"])
 
 
 class MulticutEmbeddingsEnv:
 
-    def __init__(self, cfg, device):
+    def __init__(self, cfg, device, phase="explore"):
         super(MulticutEmbeddingsEnv, self).__init__()
 
         self.reset()
@@ -26,9 +29,30 @@ class MulticutEmbeddingsEnv:
         self.device = device
         self.max_p = torch.nn.MaxPool2d(3, padding=1, stride=1)
         self.reward_function = eval("rewards." + self.cfg.reward_function)(cfg.s_subgraph)
-
+        self.graph_cache = LruCache(cfg.get("graph_cache_size", 1024))
+        self.subgraph_sampler = DenseSubgraphSampler(seed=cfg.get("subgraph_seed", 0),
+                                                     cache_size=cfg.get("graph_cache_size", 1024),
+                                                     resample_prob=cfg.get("subgraph_resample_prob", 1.))
+        # if set, the multicut of a graph is warm started from its solution of the previous step
+        warm_start_max_change = cfg.get("multicut_warm_start_max_change", None)
+        # explore and validation phase can use different multicut solvers
+        solver_kwargs = get_solver_kwargs(cfg, phase)
+        self.multicut_solver = get_solver(warm_start_max_change, cfg.get("graph_cache_size", 1024), **solver_kwargs)
+        self.multicut_pool = None
+        if cfg.get("n_multicut_workers", 0) > 0:
+            self.multicut_pool = MulticutPool(cfg.n_multicut_workers, cfg.get("graph_cache_size", 1024),
+                                              warm_start_max_change, **solver_kwargs)
+        self._anonymous_graphs = itertools.count()
+        self.node_actions = cfg.get("node_actions", False)
+
+    @property
+    def n_actions(self):
+        """the policy acts on every node with node_actions and on every edge otherwise"""
+        return self.graph.n_nodes if self.node_actions else self.graph.n_edges
 
     def execute_action(self, actions, logg_vals=None, post_stats=False, post_images=False, tau=None, train=True):
+        if self.node_actions:
+            actions = node_to_edge_actions(actions, self.edge_ids)
         self.current_edge_weights = actions.squeeze()
         self.current_soln = self.get_current_soln(self.current_edge_weights)
 
@@ -75,71 +99,93 @@ class MulticutEmbeddingsEnv:
         return reward
 
     def get_state(self):
-        return State(self.raw, self.batched_sp_seg, self.edge_ids, self.edge_feat, self.node_feat,
+        return State(self.raw, self.batched_sp_seg, self.graph, self.edge_feat, self.node_feat,
                      self.subgraph_indices, self.sep_subgraphs, self.gt_edge_weights)
 
     def update_data(self, raw, gt, edge_ids, gt_edges, sp_seg, rags, edge_feat, node_feat, *args, **kwargs):
-        bs = raw.shape[0]
+        self.set_data(self.prepare_data(raw, gt, edge_ids, gt_edges, sp_seg, rags, edge_feat, node_feat))
+
+    def prepare_data(self, raw, gt, edge_ids, gt_edges, sp_seg, rags, edge_feat, node_feat, keys=None, *args,
+                     **kwargs):
+        """
+        computes everything the environment needs from a batch without touching the state of the current episode,
+        so it can run in a background thread. The returned dict is loaded by set_data.
+        keys optionally identify the graphs of the batch (e.g. (file, patch)), their subgraphs are then cached.
+        """
         dev = raw.device
         for _sp_seg in sp_seg:
             assert all(_sp_seg.unique() == torch.arange(_sp_seg.max() + 1, device=dev))
 
-        self.rags = rags
-        self.gt_seg, self.init_sp_seg = gt.squeeze(1), sp_seg.squeeze(1)
-        self.raw = raw
-        self.node_feat = node_feat if node_feat is None else torch.cat(node_feat, 0)
-        self.edge_feat = edge_feat if edge_feat is None else torch.cat(edge_feat, 0)
-
-        subgraphs, self.sep_subgraphs = [], []
-        _subgraphs, _sep_subgraphs = find_dense_subgraphs([eids.transpose(0, 1).cpu().numpy() for eids in edge_ids], self.cfg.s_subgraph)
-        _subgraphs = [torch.from_numpy(sg.astype(np.int64)).to(dev).permute(2, 0, 1) for sg in _subgraphs]
-        _sep_subgraphs = [torch.from_numpy(sg.astype(np.int64)).to(dev).permute(2, 0, 1) for sg in _sep_subgraphs]
-
-        self.dir_edge_ids = [torch.cat([_edge_ids, torch.stack([_edge_ids[1], _edge_ids[0]], dim=0)], dim=1) for _edge_ids in edge_ids]
-        self.n_nodes = [eids.max() + 1 for eids in edge_ids]
-        self.edge_ids, (self.n_offs, self.e_offs) = collate_edges(edge_ids)
-        for i in range(len(self.cfg.s_subgraph)):
-            subgraphs.append(torch.cat([sg + self.n_offs[i] for i, sg in enumerate(_subgraphs[i*bs:(i+1)*bs])], -2).flatten(-2, -1))
-            self.sep_subgraphs.append(torch.cat(_sep_subgraphs[i*bs:(i+1)*bs], -2).flatten(-2, -1))
-
-        self.subgraphs = subgraphs
-        self.subgraph_indices = get_edge_indices(self.edge_ids, subgraphs)
+        data = {"rags": rags, "gt_seg": gt.squeeze(1), "init_sp_seg": sp_seg.squeeze(1), "raw": raw,
+                "node_feat": node_feat if node_feat is None else torch.cat(node_feat, 0),
+                "edge_feat": edge_feat if edge_feat is None else torch.cat(edge_feat, 0)}
+
+        # superpixels are consecutive, so isolated nodes with the largest ids are counted as well
+        data["n_nodes"] = [int(_sp_seg.max()) + 1 for _sp_seg in sp_seg]
+        graph = BatchedGraph.from_edges(edge_ids, data["n_nodes"])
+        data["graph"], data["edge_ids"] = graph, graph.edge_index
+        data["dir_edge_ids"] = graph.get_local_dir_edges()
+        data["n_offs"], data["e_offs"] = graph.node_offsets, graph.edge_offsets
+        # handles of the graphs in the multicut workers, graphs without key are only valid for this batch
+        data["graph_handles"] = keys if keys is not None else \
+            [("batch", next(self._anonymous_graphs)) for _ in range(graph.n_graphs)]
+
+        # subgraphs are sampled as edge indices into the batched graph, so no edge lookup is needed
+        data["subgraph_indices"], data["subgraphs"], data["sep_subgraphs"] = [], [], []
+        for sz in self.cfg.s_subgraph:
+            sg_indices = torch.cat(self.subgraph_sampler.sample(graph, sz, keys), 0)
+            sg_edges = graph.edge_index[:, sg_indices]
+            data["subgraph_indices"].append(sg_indices.flatten())
+            data["subgraphs"].append(sg_edges.flatten(-2, -1))
+            data["sep_subgraphs"].append(separate_subgraphs(sg_edges).flatten(-2, -1))
 
         batched_sp = []
-        for sp, off in zip(self.init_sp_seg, self.n_offs):
+        for sp, off in zip(data["init_sp_seg"], data["n_offs"]):
             batched_sp.append(sp + off)
-        self.batched_sp_seg = torch.stack(batched_sp, 0)
-
-        self.gt_edge_weights = gt_edges
+        data["batched_sp_seg"] = torch.stack(batched_sp, 0)
+
+        data["gt_edge_weights"] = gt_edges
+        if gt_edges is not None:
+            data["gt_edge_weights"] = torch.cat(gt_edges)
+            data["sg_gt_edges"] = [data["gt_edge_weights"][sg].view(-1, sz) for sz, sg in
+                                   zip(self.cfg.s_subgraph, data["subgraph_indices"])]
+        return data
+
+    def set_data(self, data):
+        """loads the data returned by prepare_data"""
+        for key, val in data.items():
+            setattr(self, key, val)
         if self.gt_edge_weights is not None:
-            self.gt_edge_weights = torch.cat(self.gt_edge_weights)
-            self.gt_soln = self.get_current_soln(self.gt_edge_weights)
-            self.sg_gt_edges = [self.gt_edge_weights[sg].view(-1, sz) for sz, sg in
-                                zip(self.cfg.s_subgraph, self.subgraph_indices)]
+            # the ground truth must not seed the warm started solves of the agent's edges
+            self.gt_soln = self.get_current_soln(self.gt_edge_weights, warm_start=False)
 
         self.current_edge_weights = torch.ones(self.edge_ids.shape[1], device=self.edge_ids.device) / 2
 
-        return
-
-    def get_current_soln(self, edge_weights):
+    def get_current_soln(self, edge_weights, warm_start=True):
         p_min = 0.001
         p_max = 1.
-        segmentations = []
+        all_costs = []
         for i in range(1, len(self.e_offs)):
             probs = edge_weights[self.e_offs[i-1]:self.e_offs[i]]
             probs -= probs.min()
             probs /= probs.max()
             costs = (p_max - p_min) * probs + p_min
-            costs = (torch.log((1. - costs) / costs)).detach().cpu().numpy()
-            node_labels = elf.segmentation.multicut.multicut_decomposition(self.rags[i-1], costs, internal_solver='greedy-additive', n_threads=4)
-            mc_seg = project_node_labels_to_pixels(self.rags[i-1], node_labels).squeeze()
-
-            mc_seg = torch.from_numpy(mc_seg.astype(np.long)).to(self.device)
-            # mask = mc_seg[None] == torch.unique(mc_seg)[:, None, None]
-            # mc_seg = (mask * (torch.arange(len(torch.unique(mc_seg)), device=mc_seg.device)[:, None, None] + 1)).sum(0) - 1
-
-            segmentations.append(mc_seg)
-        return torch.stack(segmentations, dim=0)
+            all_costs.append((torch.log((1. - costs) / costs)).detach().cpu().numpy())
+
+        if self.multicut_pool is None:
+            node_labels = [self.multicut_solver(handle, rag, costs, warm_start)
+                           for handle, rag, costs in zip(self.graph_handles, self.rags, all_costs)]
+        else:
+            # only the costs and the graph handles go to the workers, the pixels stay here
+            graphs = [lambda i=i: (self.graph.get_edges(i, local=True).t().cpu().numpy(), self.n_nodes[i])
+                      for i in range(self.graph.n_graphs)]
+            node_labels = self.multicut_pool.solve(self.graph_handles, graphs, all_costs, warm_start)
+
+        # only the node labels are uploaded, they are projected to the pixels on the device of the superpixels
+        sizes = [len(labels) for labels in node_labels]
+        node_labels = torch.from_numpy(np.concatenate(node_labels).astype(np.int64)).to(self.init_sp_seg.device)
+        return torch.stack([labels[sp_seg.long()] for labels, sp_seg in
+                            zip(torch.split(node_labels, sizes), self.init_sp_seg)], dim=0)
 
     def reset(self):
         self.acc_reward = []
@@ -0,0 +1,100 @@
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from environments.multicut import MulticutEmbeddingsEnv, State
+from utils.batched_graph import BatchedGraph
+
+
+def _cat_or_none(tensors, dim=0):
+    return None if tensors[0] is None else torch.cat(tensors, dim)
+
+
+def collate_states(states):
+    """
+    collates the States of several environments into one, such that a single forward of the agent serves all of
+    them. The raw images of all environments need the same shape.
+    """
+    if len(states) == 1:
+        return states[0]
+    graph = BatchedGraph.cat([state.graph for state in states])
+    n_offs, e_offs = [0], [0]
+    for state in states[:-1]:
+        n_offs.append(n_offs[-1] + state.graph.n_nodes)
+        e_offs.append(e_offs[-1] + state.graph.n_edges)
+    n_sizes = len(states[0].subgraph_indices)
+    return State(raw=torch.cat([state.raw for state in states], 0),
+                 sp_seg=torch.cat([state.sp_seg + off for state, off in zip(states, n_offs)], 0),
+                 graph=graph,
+                 edge_feat=_cat_or_none([state.edge_feat for state in states]),
+                 node_feat=_cat_or_none([state.node_feat for state in states]),
+                 subgraph_indices=[torch.cat([state.subgraph_indices[i] + off for state, off in zip(states, e_offs)])
+                                   for i in range(n_sizes)],
+                 sep_subgraphs=[torch.cat([state.sep_subgraphs[i] for state in states], 1) for i in range(n_sizes)],
+                 gt_edge_weights=_cat_or_none([state.gt_edge_weights for state in states]))
+
+
+def collate_states_by_shape(states):
+    """
+    collates runs of consecutive states whose raw images have the same shape, e.g. batches from different shape
+    buckets. Concatenating the actions for the returned states gives the actions in the order of states.
+    """
+    runs = []
+    for state in states:
+        if len(runs) > 0 and runs[-1][-1].raw.shape[1:] == state.raw.shape[1:]:
+            runs[-1].append(state)
+        else:
+            runs.append([state])
+    return [collate_states(run) for run in runs]
+
+
+class VecMulticutEnv(object):
+    """
+    holds n_envs independent MulticutEmbeddingsEnvs, each with its own batch of data. get_collated_states collates
+    their states, so the policy is evaluated once for all episodes (once per raw shape if the batches of the
+    environments differ in shape), and execute_action splits the actions again and runs the
+    solving and the rewards of the environments concurrently in a thread pool (nifty and torch release the GIL, with
+    n_multicut_workers the solving happens in processes).
+    """
+
+    def __init__(self, cfg, device, n_envs=1):
+        self.envs = [MulticutEmbeddingsEnv(cfg, device) for _ in range(n_envs)]
+        self.executor = ThreadPoolExecutor(max_workers=n_envs) if n_envs > 1 else None
+
+    def __len__(self):
+        return len(self.envs)
+
+    @property
+    def n_actions(self):
+        return sum(env.n_actions for env in self.envs)
+
+    def reset(self):
+        for env in self.envs:
+            env.reset()
+
+    def get_states(self):
+        return [env.get_state() for env in self.envs]
+
+    def get_collated_states(self):
+        """:return: a list with usually one collated state, see collate_states_by_shape"""
+        return collate_states_by_shape(self.get_states())
+
+    def split_actions(self, actions):
+        """splits actions for the collated state (one per edge or one per node) into the actions of the environments"""
+        return torch.split(actions, [env.n_actions for env in self.envs], dim=0)
+
+    def execute_action(self, actions, logg_vals=None, post_stats=False, post_images=False, tau=None, train=True):
+        """:return: the rewards of the environments, only the first one posts stats and images"""
+        actions = self.split_actions(actions)
+        if self.executor is None:
+            return [self.envs[0].execute_action(actions[0], logg_vals, post_stats, post_images, tau, train)]
+        futures = [self.executor.submit(env.execute_action, action, logg_vals if i == 0 else None,
+                                        post_stats and i == 0, post_images and i == 0, tau, train)
+                   for i, (env, action) in enumerate(zip(self.envs, actions))]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        for env in self.envs:
+            if env.multicut_pool is not None:
+                env.multicut_pool.close()
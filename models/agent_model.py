@@ -37,12 +37,14 @@ class Agent(torch.nn.Module):
         for param in self.fe_ext_tgt.parameters():
             param.requires_grad = False
 
-        self.actor = PolicyNet(dim_embed, 2, cfg.gnn_n_hl, cfg.gnn_size_hl, distance, device, False, cfg.gnn_act_depth,
-                               cfg.gnn_act_norm_inp, cfg.n_init_edge_feat)
+        node_actions = cfg.get("node_actions", False)
+        self.actor = PolicyNet(dim_embed, 2, cfg.gnn_n_hl, cfg.gnn_size_hl, distance, device, node_actions,
+                               cfg.gnn_act_depth, cfg.gnn_act_norm_inp, cfg.n_init_edge_feat)
         self.critic = QValueNet(self.cfg.s_subgraph, dim_embed, 1, 1, cfg.gnn_n_hl, cfg.gnn_size_hl, distance, device,
-                                False, cfg.gnn_crit_depth, cfg.gnn_crit_norm_inp, cfg.n_init_edge_feat)
+                                node_actions, cfg.gnn_crit_depth, cfg.gnn_crit_norm_inp, cfg.n_init_edge_feat)
         self.critic_tgt = QValueNet(self.cfg.s_subgraph, dim_embed, 1, 1, cfg.gnn_n_hl, cfg.gnn_size_hl, distance,
-                                    device, False, cfg.gnn_crit_depth, cfg.gnn_crit_norm_inp, cfg.n_init_edge_feat)
+                                    device, node_actions, cfg.gnn_crit_depth, cfg.gnn_crit_norm_inp,
+                                    cfg.n_init_edge_feat)
 
         self.log_alpha = torch.tensor([np.log(self.cfg.init_temperature)] * len(self.cfg.s_subgraph)).to(device)
         if with_temp:
@@ -74,7 +76,7 @@ class Agent(torch.nn.Module):
     def forward(self, state, actions, expl_action, post_data, policy_opt, return_node_features, get_embeddings):
         state = self.StateClass(*state)
 
-        edge_index = torch.cat([state.edge_ids, torch.stack([state.edge_ids[1], state.edge_ids[0]], dim=0)], dim=1)  # gcnn expects two directed edges for one undirected edge
+        edge_index = state.graph.dir_edge_index  # gcnn expects two directed edges for one undirected edge
 
         if actions is None:
             node_features_tgt, edge_features_tgt, embeddings_tgt = self.get_features(self.fe_ext_tgt, state, grad=False)
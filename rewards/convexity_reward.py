@@ -1,5 +1,6 @@
 import sys
 from rewards.reward_abc import RewardFunctionAbc
+from utils.relabel import relabel_with_lut
 from skimage.measure import approximate_polygon, find_contours
 from skimage.draw import polygon_perimeter, line
 from skimage.transform import hough_circle, hough_circle_peaks
@@ -31,12 +32,8 @@ class DSBReward(RewardFunctionAbc):
                 edge_score = edge_score[edges].max(dim=0).values
                 edge_scores.append(edge_score)
                 continue
-            # get one-hot representation
-            one_hot = torch.zeros((int(single_pred.max()) + 1,) + single_pred.size(), device=dev, dtype=torch.long) \
-                .scatter_(0, single_pred[None], 1)
-
             # need masses to determine what potential_objects can be considered background
-            label_masses = one_hot.flatten(1).sum(-1)
+            label_masses = torch.bincount(single_pred.flatten(), minlength=int(single_pred.max()) + 1)
             # everything else are potential potential_objects
             bg_obj_mask = label_masses > 1400
             potenial_obj_mask = label_masses <= 1400
@@ -44,13 +41,12 @@ class DSBReward(RewardFunctionAbc):
             bg_object_ids = torch.nonzero(bg_obj_mask).squeeze(1)  # object label IDs
             potential_object_ids = torch.nonzero(potenial_obj_mask).squeeze(1)  # object label IDs
 
-            potential_objects = one_hot[potential_object_ids]  # get object masks
-            bg_sp_ids = torch.unique((single_sp_seg[None] + 1) * one_hot[bg_object_ids])[1:] - 1
-            object_sp_ids = [torch.unique((single_sp_seg[None] + 1) * obj)[1:] - 1 for obj in potential_objects]
-            false_sp_ids = torch.unique((single_sp_seg[None] + 1) * one_hot[false_obj_mask])[1:] - 1
+            bg_sp_ids = torch.unique(single_sp_seg[bg_obj_mask[single_pred]])
+            false_sp_ids = torch.unique(single_sp_seg[false_obj_mask[single_pred]])
 
             # Detect two radii
-            potential_fg = (potential_objects * torch.arange(len(potential_objects), device=dev)[:, None, None]).sum(0).float()
+            potential_fg = relabel_with_lut(single_pred, potential_object_ids,
+                                            torch.arange(len(potential_object_ids), device=dev)).float()
             edge_image = ((- self.max_p(-potential_fg.unsqueeze(0)).squeeze()) != potential_fg).float().cpu().numpy()
             hough_radii = np.arange(self.range_rad[0], self.range_rad[1])
             hough_res = hough_circle(edge_image, hough_radii)
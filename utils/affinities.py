@@ -38,7 +38,9 @@ def get_naive_affinities(raw, offsets):
     for i, off in enumerate(offsets):
         rolled = np.roll(raw, tuple(-np.array(off)), (0, 1))
         dist = np.linalg.norm(raw - rolled, axis=-1)
-        affinities.append(dist / dist.max())
+        # all distances are 0 on a constant image, they stay 0 instead of becoming nan
+        max_dist = dist.max()
+        affinities.append(dist / max_dist if max_dist > 0 else dist)
     return np.stack(affinities)
 
 def get_affinities_from_embeddings_2d(embeddings, offsets, delta, distance):
@@ -0,0 +1,148 @@
+import weakref
+import torch
+from utils.graphs import collate_edges
+
+
+class BatchedGraph(object):
+    """
+    a batch of undirected graphs. The edges of all graphs are concatenated into edge_index with node ids shifted by
+    the node offset of their graph. Derived structures (directed edges, CSR/CSC adjacency) are built
+    once on first use and shared by everything that holds the graph (environment, agent, rewards, replay memory).
+    The graph is treated as immutable.
+    """
+
+    def __init__(self, edge_index, node_offsets, edge_offsets):
+        """
+        :param edge_index: tensor of shape (2, E), batched edges
+        :param node_offsets: list of B + 1 ints, nodes of graph i are node_offsets[i]:node_offsets[i + 1]
+        :param edge_offsets: list of B + 1 ints, edges of graph i are edge_offsets[i]:edge_offsets[i + 1]
+        """
+        self.edge_index = edge_index
+        self.node_offsets = [int(o) for o in node_offsets]
+        self.edge_offsets = [int(o) for o in edge_offsets]
+        self._dir_edge_index = None
+        self._local_dir_edges = None
+        self._csr = None
+        self._csc = None
+        self._copies = weakref.WeakValueDictionary()
+
+    @classmethod
+    def from_edges(cls, edges, n_nodes=None):
+        """
+        :param edges: list of tensors of shape (2, E_i), they are not modified
+        :param n_nodes: optional list with the number of nodes of each graph, by default the largest node id + 1
+        """
+        edge_index, (node_offsets, edge_offsets) = collate_edges(edges, n_nodes)
+        return cls(edge_index, node_offsets, edge_offsets)
+
+    @classmethod
+    def cat(cls, graphs):
+        """concatenates BatchedGraphs into one, the graphs of graphs[k] follow the ones of graphs[k - 1]"""
+        node_offsets, edge_offsets, edge_index = [0], [0], []
+        for graph in graphs:
+            edge_index.append(graph.edge_index + node_offsets[-1])
+            node_offsets += [node_offsets[-1] + o for o in graph.node_offsets[1:]]
+            edge_offsets += [edge_offsets[-1] + o for o in graph.edge_offsets[1:]]
+        return cls(torch.cat(edge_index, 1), node_offsets, edge_offsets)
+
+    def __getstate__(self):
+        # derived structures are rebuilt on demand
+        return {"edge_index": self.edge_index, "node_offsets": self.node_offsets, "edge_offsets": self.edge_offsets}
+
+    def __setstate__(self, state):
+        self.__init__(state["edge_index"], state["node_offsets"], state["edge_offsets"])
+
+    @property
+    def device(self):
+        return self.edge_index.device
+
+    @property
+    def n_graphs(self):
+        return len(self.node_offsets) - 1
+
+    @property
+    def n_nodes(self):
+        return self.node_offsets[-1]
+
+    @property
+    def n_edges(self):
+        return self.edge_offsets[-1]
+
+    def get_edges(self, i, local=False):
+        """edges of graph i. A view into edge_index with batched node ids or a copy with the node ids of graph i"""
+        edges = self.edge_index[:, self.edge_offsets[i]:self.edge_offsets[i + 1]]
+        return edges - self.node_offsets[i] if local else edges
+
+    def get_nodes(self, i):
+        return torch.arange(self.node_offsets[i], self.node_offsets[i + 1], device=self.device)
+
+    @property
+    def dir_edge_index(self):
+        """every undirected edge as two directed edges, the first E are edge_index, the second E their reverse"""
+        if self._dir_edge_index is None:
+            self._dir_edge_index = torch.cat([self.edge_index, self.edge_index.flip(0)], 1)
+        return self._dir_edge_index
+
+    def get_local_dir_edges(self):
+        """list with the directed edges of every graph in its own node ids, laid out like dir_edge_index"""
+        if self._local_dir_edges is None:
+            self._local_dir_edges = []
+            for i in range(self.n_graphs):
+                edges = self.get_edges(i, local=True)
+                self._local_dir_edges.append(torch.cat([edges, edges.flip(0)], 1))
+        return self._local_dir_edges
+
+    def _compress(self, rows, cols):
+        order = torch.argsort(rows * self.n_nodes + cols)
+        row_ptr = torch.zeros(self.n_nodes + 1, dtype=torch.long, device=self.device)
+        row_ptr[1:] = torch.cumsum(torch.bincount(rows, minlength=self.n_nodes), 0)
+        return row_ptr, cols[order], order
+
+    def get_csr(self):
+        """
+        adjacency of the directed edges in compressed sparse row format
+        :return: row_ptr (n_nodes + 1), the neighbors of node n are col[row_ptr[n]:row_ptr[n + 1]] and
+                 dir_edge_index[:, perm[row_ptr[n]:row_ptr[n + 1]]] are the according directed edges
+        """
+        if self._csr is None:
+            self._csr = self._compress(self.dir_edge_index[0], self.dir_edge_index[1])
+        return self._csr
+
+    def get_csc(self):
+        """same as get_csr but grouped by the target nodes of the directed edges"""
+        if self._csc is None:
+            self._csc = self._compress(self.dir_edge_index[1], self.dir_edge_index[0])
+        return self._csc
+
+    def tensors(self):
+        """all tensors of the graph and of the derived structures that are built so far"""
+        tensors = [self.edge_index]
+        if self._dir_edge_index is not None:
+            tensors.append(self._dir_edge_index)
+        if self._local_dir_edges is not None:
+            tensors += self._local_dir_edges
+        for compressed in (self._csr, self._csc):
+            if compressed is not None:
+                tensors += list(compressed)
+        return tensors
+
+    def to(self, device, non_blocking=False):
+        """
+        returns the graph on device. Copies are remembered as long as they are alive anywhere else, so moving the
+        same graph to a device again (e.g. for several states of one batch) does not copy it again. The references
+        are weak, so a graph in the replay memory does not keep its device copies alive.
+        """
+        device = torch.device(device)
+        if device == self.device:
+            return self
+        key = str(device)
+        graph = self._copies.get(key)
+        if graph is None:
+            graph = BatchedGraph(self.edge_index.to(device, non_blocking=non_blocking), self.node_offsets,
+                                 self.edge_offsets)
+            graph._copies[str(self.device)] = self
+            self._copies[key] = graph
+        return graph
+
+    def cpu(self):
+        return self.to("cpu")
@@ -0,0 +1,139 @@
+import itertools
+import collections
+import numpy as np
+import elf.segmentation.multicut as mc
+from utils.graphs import graph_from_uv_ids
+from utils.multicut_solvers import solve_multicut
+
+Block = collections.namedtuple("Block", ["outer", "inner", "inner_in_outer"])
+
+
+def get_blocks(shape, block_shape, halo):
+    """
+    tiles shape into blocks of block_shape in raster order. The outer slices extend each block by halo (clipped at
+    the borders), inner_in_outer removes the halo again from an outer block, similar to models.unet3d.utils.remove_halo.
+    """
+    grid = [range(0, s, b) for s, b in zip(shape, block_shape)]
+    for begin in itertools.product(*grid):
+        inner = tuple(slice(b, min(b + bs, s)) for b, bs, s in zip(begin, block_shape, shape))
+        outer = tuple(slice(max(i.start - h, 0), min(i.stop + h, s)) for i, h, s in zip(inner, halo, shape))
+        inner_in_outer = tuple(slice(i.start - o.start, i.stop - o.start) for i, o in zip(inner, outer))
+        yield Block(outer, inner, inner_in_outer)
+
+
+def _adjacent_pairs(seg):
+    """returns the pairs of different, non zero labels of direct neighbors in seg with the number of neighboring pixels"""
+    pairs = []
+    for axis in range(seg.ndim):
+        lower = seg[tuple(slice(0, -1) if d == axis else slice(None) for d in range(seg.ndim))].ravel()
+        upper = seg[tuple(slice(1, None) if d == axis else slice(None) for d in range(seg.ndim))].ravel()
+        mask = (lower != upper) & (lower != 0) & (upper != 0)
+        pairs.append(np.stack([np.minimum(lower[mask], upper[mask]), np.maximum(lower[mask], upper[mask])], 1))
+    return np.unique(np.concatenate(pairs, 0), axis=0, return_counts=True)
+
+
+def _lookup(keys, values, queries, default):
+    """looks up queries in the sorted keys and returns their values (default for missing ones) and a found mask"""
+    out = np.full(len(queries), default, dtype=values.dtype)
+    if len(keys) == 0:
+        return out, np.zeros(len(queries), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    found = keys[pos] == queries
+    out[found] = values[pos[found]]
+    return out, found
+
+
+def _majority_labels(seg, labels):
+    """returns the sorted non zero ids of seg and for each of them the label it overlaps most with"""
+    mask = seg != 0
+    pairs, counts = np.unique(np.stack([seg[mask], labels[mask]]), axis=1, return_counts=True)
+    order = np.lexsort((-counts, pairs[0]))
+    ids, first = np.unique(pairs[0, order], return_index=True)
+    return ids, pairs[1, order][first]
+
+
+class BlockGraphStitcher(object):
+    """
+    stitches the superpixel graphs of blocks into one global graph. The superpixels of every block are written
+    into labels (an array like of the full spatial shape, e.g. a zero initialized h5 dataset) with globally unique ids
+    starting at 1, 0 marks the area of blocks that were not added yet. Blocks have to be added in the order of
+    get_blocks.
+    Edges to superpixels of earlier blocks get the probability predicted for the block superpixels they overlap with
+    in the halo. Along axes without halo there is no such prediction and the probability is one minus the fraction of
+    neighboring pixels of the smaller superpixel, which links the slices of a volume that is processed slice by slice.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.n_nodes = 1
+        self.uv_ids, self.edge_probs = [], []
+
+    def add_block(self, block, sp_seg, edges, edge_probs):
+        """
+        :param sp_seg: np.ndarray, consecutive superpixels of the outer block starting at 0
+        :param edges: np.ndarray of shape (2, E), edges between the superpixels in sp_seg
+        :param edge_probs: np.ndarray of shape (E,), boundary probabilities of the edges
+        """
+        inner_seg = sp_seg[block.inner_in_outer]
+        own_local = np.unique(inner_seg)
+        first_own = self.n_nodes
+        to_global = np.zeros(int(sp_seg.max()) + 1, dtype=np.int64)
+        to_global[own_local] = np.arange(first_own, first_own + len(own_local))
+        self.labels[block.inner] = to_global[inner_seg]
+        self.n_nodes += len(own_local)
+
+        # the outer block extended by one pixel towards the earlier blocks, such that their superpixels are also
+        # visible along axes without halo
+        context = tuple(slice(max(o.start - 1, 0), o.stop) for o in block.outer)
+        outer_in_context = tuple(slice(o.start - c.start, o.stop - c.start) for o, c in zip(block.outer, context))
+        global_seg = np.asarray(self.labels[context]).astype(np.int64)
+        uv_ids, n_touching = _adjacent_pairs(global_seg)
+        # own superpixels have the largest ids so far, keep the edges that touch at least one of them
+        keep = uv_ids[:, 1] >= first_own
+        uv_ids, n_touching = uv_ids[keep], n_touching[keep]
+        if len(uv_ids) == 0:
+            return
+
+        foreign_seg = np.where(global_seg[outer_in_context] < first_own, global_seg[outer_in_context], 0)
+        foreign_ids, foreign_local = _majority_labels(foreign_seg, sp_seg)
+        local_uv, covered = np.zeros_like(uv_ids), np.ones(len(uv_ids), dtype=bool)
+        for j in range(2):
+            own = uv_ids[:, j] >= first_own
+            local_uv[own, j] = own_local[uv_ids[own, j] - first_own]
+            local_uv[~own, j], found = _lookup(foreign_ids, foreign_local, uv_ids[~own, j], 0)
+            covered[~own] &= found
+
+        # look up the predictions of the local edges, superpixels that map to the same local one are merged
+        n_local = int(sp_seg.max()) + 1
+        edge_keys = np.sort(edges, 0).T @ np.array([n_local, 1])
+        order = np.argsort(edge_keys)
+        probs, _ = _lookup(edge_keys[order], np.asarray(edge_probs, dtype=np.float64)[order],
+                           np.sort(local_uv, 1) @ np.array([n_local, 1]), 0.5)
+        probs[local_uv[:, 0] == local_uv[:, 1]] = 0.
+
+        if not covered.all():
+            sizes = np.bincount(global_seg.ravel(), minlength=self.n_nodes)
+            min_sizes = np.minimum(sizes[uv_ids[:, 0]], sizes[uv_ids[:, 1]])
+            probs[~covered] = 1 - np.minimum(n_touching[~covered] / min_sizes[~covered], 1)
+
+        self.uv_ids.append(uv_ids)
+        self.edge_probs.append(probs)
+
+    def get_graph(self):
+        """:return: global uv ids, their boundary probabilities and the number of nodes (including the unused 0)"""
+        if len(self.uv_ids) == 0:
+            return np.zeros((0, 2), dtype=np.int64), np.zeros(0), self.n_nodes
+        return np.concatenate(self.uv_ids), np.concatenate(self.edge_probs), self.n_nodes
+
+    def solve_multicut(self, p_min=0.001, solver="decomposition", time_limit=None, n_threads=4):
+        """multicut on the stitched graph, returns a label for every global superpixel id"""
+        uv_ids, probs, n_nodes = self.get_graph()
+        graph = graph_from_uv_ids(uv_ids, n_nodes)
+        costs = mc.transform_probabilities_to_costs(np.clip(probs, p_min, 1 - p_min))
+        return solve_multicut(graph, costs, solver, time_limit, n_threads)
+
+
+def project_blockwise(labels, node_labels, blocks, out):
+    """writes node_labels[labels] block by block into out, which can be labels itself"""
+    for block in blocks:
+        out[block.inner] = node_labels[np.asarray(labels[block.inner])]
@@ -0,0 +1,25 @@
+import os
+
+
+class ForkSafe(object):
+    """
+    mixin for objects with state that only belongs to one process, like locks, open files or caches.
+    Pickling keeps only the constructor arguments listed in _init_args, the receiving process builds a fresh object
+    from them. After a fork (e.g. in DataLoader workers) _check_pid does the same, because inherited locks might have
+    been held by another thread of the parent and inherited handles belong to the parent.
+    Subclasses call ForkSafe.__init__ and _check_pid before they touch their state.
+    """
+    _init_args = ()
+
+    def __init__(self):
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._init_args}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.__init__(**self.__getstate__())
@@ -10,6 +10,7 @@ from sklearn.decomposition import PCA
 from scipy.cluster.vq import kmeans2, whiten
 from skimage.segmentation import find_boundaries
 from skimage.filters import gaussian
+from utils.relabel import relabel_consecutive, majority_projection
 
 # Global counter
 # from traitlets.tests.test_traitlets import test_subclass_override_not_registered
@@ -129,20 +130,11 @@ def calculate_gt_edge_costs(neighbors, new_seg, gt_seg, thresh):
 
 
 def project_overseg_to_seg(over_seg, seg):
-    _over_seg = over_seg + 1
-    _seg = seg + 1
-
-    onehot = _over_seg[None] == torch.unique(_over_seg)[:, None, None]
-    overlaps = onehot * _seg[None]
-    labels = torch.tensor([torch.bincount(ol)[1:].argmax().item() for ol in overlaps.flatten(1)], device=seg.device)
-    projection = (onehot * labels[:, None, None]).sum(0)
+    over_seg, labels = majority_projection(over_seg, seg)
+    projection = labels[over_seg]
 
     # make label ids consecutive
-    uni = torch.unique(projection)
-    onehot = projection[None] == uni[:, None, None]
-    projection = (onehot * torch.arange(0, len(uni), device=seg.device)[:, None, None]).sum(0)
-
-    return projection
+    return relabel_consecutive(projection)
 
 
 def bbox(array2d_c):
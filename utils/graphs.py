@@ -3,22 +3,34 @@ import numpy as np
 import vigra
 import math
 import nifty
-import elf
 import nifty.graph.agglo as nagglo
+from torch_scatter import scatter_min, scatter_max
 from elf.segmentation.watershed import watershed, apply_size_filter
 import matplotlib.pyplot as plt
 
 
-def collate_edges(edges):
-    "batches a list of graphs defined by edge arrays"
+def collate_edges(edges, n_nodes=None):
+    """
+    batches a list of graphs defined by edge arrays, the input edges are not modified
+    :param n_nodes: optional number of nodes per graph, needed if a graph has isolated nodes with the largest ids
+    :return: the batched edges and the node and edge offsets of the graphs
+    """
+    if n_nodes is None:
+        n_nodes = [int(e.max()) + 1 if e.numel() > 0 else 0 for e in edges]
     n_offs = [0]
     e_offs = [0]
     for i in range(len(edges)):
-        n_offs.append(n_offs[-1] + edges[i].max() + 1)
+        n_offs.append(n_offs[-1] + int(n_nodes[i]))
         e_offs.append(e_offs[-1] + edges[i].shape[1])
-        edges[i] += n_offs[-2]
 
-    return torch.cat(edges, 1), (n_offs, e_offs)
+    return torch.cat([e + off for e, off in zip(edges, n_offs)], 1), (n_offs, e_offs)
+
+
+def graph_from_uv_ids(uv_ids, n_nodes):
+    "builds a nifty graph from an edge list, e.g. the uv ids of a rag computed in another process"
+    graph = nifty.graph.undirectedGraph(int(n_nodes))
+    graph.insertEdges(np.asarray(uv_ids, dtype=np.uint64).reshape(-1, 2))
+    return graph
 
 
 def separate_nodes(nodes, n_offs):
@@ -35,54 +47,80 @@ def separate_edges(edges, e_offs, n_offs):
     return r_edges
 
 
-def get_edge_indices(edges, edge_list):
-    """
-    :param edges: double nested list of edges in a graph shape(n, 2). must be sorted like (smaller, larger) and must not contain equal values
-    :param edge_list: list of edges. Each edge must be present in edges. Can contain multiple entries of one edge
-    :return: the indices for edges that each entry in edge list correpsonds to
-    """
-    indices = []
-    for sg in edge_list:
-        indices.append(torch.nonzero(((edges[0] == sg[0].unsqueeze(-1)) & (edges[1] == sg[1].unsqueeze(-1))), as_tuple=True)[1])
-        assert indices[-1].shape[0] == sg.shape[1], "edges must be sorted and unique"
-    return indices
-
-def squeeze_repr(nodes, edges, seg):
+def squeeze_repr(nodes, edges, seg, inplace=True):
     """
-    This functions renames the nodes to [0,..,len(nodes)-1] in a superpixel rag consisting of nodes edges and a segmentation
+    This functions renames the nodes to [0,..,len(nodes)-1] in a superpixel rag consisting of nodes edges and a segmentation.
+    The new id of a node is its position in nodes, ids that are not in nodes are kept. Works in O((E + H*W) log N) on
+    any device via a binary search over the sorted nodes.
     :param nodes: pt tensor
     :param edges: pt tensor
     :param seg: pt tensor
-    :return: none
+    :param inplace: if true, edges and seg are renamed in place, otherwise renamed copies are returned
+    :return: the renamed edges and seg
     """
+    if len(nodes) == 0:
+        return (edges, seg) if inplace else (edges.clone(), seg.clone())
+    sorted_nodes, order = torch.sort(nodes)
 
-    _nodes = torch.arange(0, len(nodes), device=nodes.device)
-    indices = torch.where(edges.unsqueeze(0) == nodes.unsqueeze(-1).unsqueeze(-1))
-    edges[indices[1], indices[2]] = _nodes[indices[0]]
-    indices = torch.where(seg.unsqueeze(0) == nodes.unsqueeze(-1).unsqueeze(-1))
-    seg[indices[1], indices[2]] = _nodes[indices[0]].float().type(seg.dtype)
+    def _rename(data):
+        values = data.to(sorted_nodes.dtype)
+        pos = torch.searchsorted(sorted_nodes, values.contiguous()).clamp_(max=len(sorted_nodes) - 1)
+        renamed = torch.where(sorted_nodes[pos] == values, order[pos].to(values.dtype), values).type(data.dtype)
+        if inplace:
+            data[...] = renamed
+            return data
+        return renamed
 
+    return _rename(edges), _rename(seg)
 
 
-def get_position_mass_in_rag(edges, segmentation):
+def get_position_mass_in_rag(edges, segmentation, return_moments=False):
     """
-        get the normalized superpixel positions and masses in a rag
+        get the normalized superpixel positions and masses in a rag. All statistics are accumulated per superpixel
+        with bincount in O(H*W), superpixel ids are expected to be consecutive.
+        If return_moments is set, additionally returns a dict with the orientation of the major axis (relative to the
+        x axis, in [-pi/2, pi/2]), the eccentricity and the bounding boxes (y_min, x_min, y_max, x_max) of the superpixels
     """
     sigm_flatness = torch.numel(segmentation) / 500
     sigm_shift = 0.8
-    nodes = torch.unique(segmentation)
+    _, labels = torch.unique(segmentation, return_inverse=True)
+    labels = labels.flatten()
+    n_nodes = int(labels.max()) + 1
 
-    meshgrid = torch.stack(torch.meshgrid(torch.arange(segmentation.shape[0], device=segmentation.device),
-                                          torch.arange(segmentation.shape[1], device=segmentation.device)))
-    one_hot = segmentation[None] == nodes[:, None, None]
-    sup_sizes = one_hot.flatten(1).sum(-1)
-    cart_cms = (one_hot[None] * meshgrid[:, None]).flatten(2).sum(2) / sup_sizes[None]
+    y, x = torch.meshgrid(torch.arange(segmentation.shape[0], device=segmentation.device),
+                          torch.arange(segmentation.shape[1], device=segmentation.device))
+    y, x = y.flatten().double(), x.flatten().double()
+    sup_sizes = torch.bincount(labels, minlength=n_nodes)
+    cart_cms = torch.stack([torch.bincount(labels, weights=y, minlength=n_nodes),
+                            torch.bincount(labels, weights=x, minlength=n_nodes)]) / sup_sizes[None]
 
     vec = cart_cms[:, edges[0]] - cart_cms[:, edges[1]]
     angles = torch.atan(vec[0] / (vec[1] + np.finfo(float).eps))
-    angles = 2 * angles / np.pi
-    sup_sizes = torch.sigmoid(sup_sizes / sigm_flatness - sigm_shift) * 2 - 1
-    return angles, torch.cat([sup_sizes[None, :], cart_cms / torch.tensor(segmentation.shape)[:, None]], 0)
+    angles = (2 * angles / np.pi).float()
+    node_feat = torch.cat([(torch.sigmoid(sup_sizes / sigm_flatness - sigm_shift) * 2 - 1)[None],
+                           (cart_cms / torch.tensor(segmentation.shape, device=segmentation.device)[:, None]).float()], 0)
+    if not return_moments:
+        return angles, node_feat
+
+    # central second order moments
+    mu_yy = torch.bincount(labels, weights=y * y, minlength=n_nodes) / sup_sizes - cart_cms[0] ** 2
+    mu_xx = torch.bincount(labels, weights=x * x, minlength=n_nodes) / sup_sizes - cart_cms[1] ** 2
+    mu_xy = torch.bincount(labels, weights=y * x, minlength=n_nodes) / sup_sizes - cart_cms[0] * cart_cms[1]
+    half_diff = (mu_xx - mu_yy) / 2
+    root = torch.sqrt(half_diff ** 2 + mu_xy ** 2)
+    major, minor = (mu_xx + mu_yy) / 2 + root, ((mu_xx + mu_yy) / 2 - root).clamp(min=0)
+    eccentricity = torch.where(major > 0, torch.sqrt(1 - minor / major.clamp(min=np.finfo(float).eps)),
+                               torch.zeros_like(major))
+    bbox = torch.stack([scatter_min(y, labels, dim_size=n_nodes)[0], scatter_min(x, labels, dim_size=n_nodes)[0],
+                        scatter_max(y, labels, dim_size=n_nodes)[0], scatter_max(x, labels, dim_size=n_nodes)[0]])
+    moments = {"orientation": (0.5 * torch.atan2(2 * mu_xy, mu_xx - mu_yy)).float(),
+               "eccentricity": eccentricity.float(), "bbox": bbox.long()}
+    return angles, node_feat, moments
+
+
+def node_to_edge_actions(actions, edge_index):
+    """edge weights from node actions, the weight of an edge is the difference of the actions of its nodes"""
+    return (actions[edge_index[0]] - actions[edge_index[1]]).abs()
 
 
 def get_joint_sg_logprobs_edges(logprobs, scale, obs, sg_ind, sz):
@@ -90,14 +128,15 @@ def get_joint_sg_logprobs_edges(logprobs, scale, obs, sg_ind, sz):
            (1 / 2 * (1 + (2 * np.pi * scale[obs.subgraph_indices[sg_ind].view(-1, sz)] ** 2).log())).sum(-1).sum(-1)
 
 def get_joint_sg_logprobs_nodes(logprobs, scale, obs, sg_ind, sz):
-    sgs = obs.subgraphs[sg_ind].view(2, -1, sz).permute(1, 2, 0)
-    joint_logprobs = torch.zeros(sgs.shape[0], device=logprobs.device)
-    sg_entropy = torch.zeros(sgs.shape[0], device=logprobs.device)
-    for i, sg in enumerate(sgs):
-        un = torch.unique(sg)
-        joint_logprobs[i] = logprobs[un].sum()
-        sg_entropy[i] = (1 / 2 * (
-                    1 + (2 * np.pi * scale[un] ** 2).log())).sum()
+    # every node of a subgraph counts once, duplicates are masked after sorting the node ids of each subgraph
+    sg_edges = obs.graph.edge_index[:, obs.subgraph_indices[sg_ind]].view(2, -1, sz)
+    sg_nodes = torch.sort(sg_edges.permute(1, 0, 2).flatten(1), 1)[0]
+    is_first = torch.ones_like(sg_nodes, dtype=torch.bool)
+    is_first[:, 1:] = sg_nodes[:, 1:] != sg_nodes[:, :-1]
+    is_first = is_first[..., None]
+    entropy = 1 / 2 * (1 + (2 * np.pi * scale[sg_nodes].view(*sg_nodes.shape, -1) ** 2).log())
+    joint_logprobs = (logprobs[sg_nodes].view(*sg_nodes.shape, -1) * is_first).sum(-1).sum(-1)
+    sg_entropy = (entropy * is_first).sum(-1).sum(-1)
     return joint_logprobs, sg_entropy
 
 def run_watershed(hmap_, min_size=None, nhood=4):
@@ -138,8 +177,7 @@ def get_soln_graph_clustering(sp_seg, edge_ids, node_features, n_max_object):
         clustering = nagglo.agglomerativeClustering(policy)
         clustering.run()
 
-        node_labels.append(clustering.result())
-        rag = elf.segmentation.features.compute_rag(np.expand_dims(sp_seg.cpu(), axis=0))
-        labels.append(elf.segmentation.features.project_node_labels_to_pixels(rag, node_labels[-1]).squeeze())
-    return torch.from_numpy(np.stack(labels).astype(np.float)).to(node_features.device), \
-           torch.from_numpy(np.concatenate(node_labels).astype(np.float)).to(node_features.device)
+        node_labels.append(torch.from_numpy(clustering.result().astype(np.int64)).to(sp_seg.device))
+        # projection to the pixels is a gather on the device of the superpixels
+        labels.append(node_labels[-1][sp_seg.long()].squeeze())
+    return torch.stack(labels).float().to(node_features.device), torch.cat(node_labels).float().to(node_features.device)
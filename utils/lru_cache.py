@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+from utils.fork_safe import ForkSafe
+
+
+class LruCache(ForkSafe):
+    """
+    thread safe dict with a maximum number of entries, least recently used entries are evicted first.
+    After a fork the cache starts empty, like data.h5_pool.H5HandlePool.
+    """
+    _init_args = ("max_size",)
+
+    def __init__(self, max_size=1024):
+        super(LruCache, self).__init__()
+        assert max_size > 0
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._mtx = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        self._check_pid()
+        with self._mtx:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        self._check_pid()
+        with self._mtx:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, compute_fn):
+        value = self.get(key)
+        if value is None:
+            # computed outside the lock, two threads might compute the same value which is harmless
+            value = compute_fn()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self._check_pid()
+        with self._mtx:
+            self._data = OrderedDict()
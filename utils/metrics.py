@@ -2,6 +2,7 @@ import numpy as np
 from skimage.metrics import contingency_table
 from skimage.metrics import variation_of_information, adapted_rand_error
 import threading
+from utils.relabel import relabel_consecutive
 
 def precision(tp, fp, fn):
     return tp / (tp + fp) if tp > 0 else 0
@@ -20,8 +21,7 @@ def f1(tp, fp, fn):
 
 
 def _relabel(input):
-    _, unique_labels = np.unique(input, return_inverse=True)
-    return unique_labels.reshape(input.shape)
+    return relabel_consecutive(input)
 
 
 def _iou_matrix(gt, seg):
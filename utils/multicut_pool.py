@@ -0,0 +1,159 @@
+import atexit
+import multiprocessing
+import queue
+import numpy as np
+from utils.graphs import graph_from_uv_ids
+from utils.lru_cache import LruCache
+from utils.multicut_solvers import solve_multicut, kernighan_lin_from
+
+# seconds between the checks whether all workers are still alive while waiting for results
+LIVENESS_INTERVAL = 5.
+
+
+class WarmStartMulticut(object):
+    """
+    keeps the last solution and costs of every graph handle. When the costs of a graph changed little since its last
+    solve, i.e. at most a fraction max_change of the edges switched between attractive and repulsive, Kernighan-Lin
+    is warm started from the previous node labels, otherwise the graph is solved from scratch with solve_multicut and
+    solver_kwargs. Solves with warm_start=False (e.g. of the ground truth costs) are always cold and neither use nor
+    replace the stored solution.
+    """
+
+    def __init__(self, max_change=0.1, cache_size=1024, **solver_kwargs):
+        self.max_change = max_change
+        self.solutions = LruCache(cache_size)
+        self.solver_kwargs = solver_kwargs
+
+    def __call__(self, handle, graph, costs, warm_start=True):
+        if not warm_start:
+            return solve_multicut(graph, costs, **self.solver_kwargs)
+        previous = self.solutions.get(handle)
+        if previous is not None and len(previous[1]) == len(costs) and \
+                np.mean(np.sign(previous[1]) != np.sign(costs)) <= self.max_change:
+            node_labels = kernighan_lin_from(graph, costs, previous[0], self.solver_kwargs.get("time_limit", None))
+        else:
+            node_labels = solve_multicut(graph, costs, **self.solver_kwargs)
+        self.solutions.put(handle, (node_labels, costs))
+        return node_labels
+
+
+def get_solver(warm_start_max_change=None, cache_size=1024, **solver_kwargs):
+    """
+    :param solver_kwargs: solver, time_limit and n_threads as taken by utils.multicut_solvers.solve_multicut
+    :return: a callable (handle, graph, costs, warm_start=True) -> node labels
+    """
+    if warm_start_max_change is not None:
+        return WarmStartMulticut(warm_start_max_change, cache_size, **solver_kwargs)
+    return lambda handle, graph, costs, warm_start=True: solve_multicut(graph, costs, **solver_kwargs)
+
+
+def _worker_loop(tasks, results, cache_size, warm_start_max_change, solver_kwargs):
+    graphs = LruCache(cache_size)
+    solver = get_solver(warm_start_max_change, cache_size, **solver_kwargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, handle, uv_ids, n_nodes, costs, warm_start = task
+        try:
+            if uv_ids is not None:
+                graphs.put(handle, graph_from_uv_ids(uv_ids, n_nodes))
+            results.put((job_id, solver(handle, graphs.get(handle), costs, warm_start), None))
+        except Exception as e:
+            results.put((job_id, None, repr(e)))
+
+
+class MulticutPool(object):
+    """
+    solves the multicuts of a batch of graphs concurrently in persistent worker processes.
+    Graphs are identified by a handle (e.g. (file, patch)) and always go to the same worker, which keeps them in an
+    LRU cache. The uv ids of a graph are only sent when its worker does not hold it, otherwise a solve only transfers
+    the handle, the costs and the node labels. The pool keeps a mirror of every worker cache, both see the same
+    sequence of handles and therefore evict the same graphs. With warm_start_max_change the workers solve with
+    WarmStartMulticut, the previous solutions then also stay in the worker of their graph.
+    A pool is used by one thread at a time (one per environment). If a worker dies (e.g. killed for its memory or by a
+    crash in the solver), solve raises and the next solve starts new workers.
+    """
+
+    def __init__(self, n_workers, cache_size=1024, warm_start_max_change=None, **solver_kwargs):
+        self.n_workers = n_workers
+        self.cache_size = cache_size
+        self.warm_start_max_change = warm_start_max_change
+        self.solver_kwargs = solver_kwargs
+        self._workers = None
+        atexit.register(self.close)
+
+    def _start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._results = ctx.Queue()
+        self._tasks, self._workers, self._sent = [], [], []
+        for _ in range(self.n_workers):
+            tasks = ctx.Queue()
+            worker = ctx.Process(target=_worker_loop, daemon=True,
+                                 args=(tasks, self._results, self.cache_size, self.warm_start_max_change,
+                                       self.solver_kwargs))
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+            self._sent.append(LruCache(self.cache_size))
+
+    def _worker_id(self, handle):
+        return hash(handle) % self.n_workers
+
+    def solve(self, handles, graphs, costs, warm_start=True):
+        """
+        :param handles: hashable handle per graph
+        :param graphs: list of callables returning (uv_ids, n_nodes) of a graph, only called for graphs that are
+                       not cached in their worker yet
+        :param costs: list of np.ndarray with the edge costs of each graph
+        :param warm_start: False solves cold and leaves the stored solutions untouched
+        :return: list with the node labels of each graph in the order of handles
+        """
+        if self._workers is None:
+            self._start()
+        for job_id, (handle, get_graph, _costs) in enumerate(zip(handles, graphs, costs)):
+            w = self._worker_id(handle)
+            uv_ids, n_nodes = None, None
+            if self._sent[w].get(handle) is None:
+                uv_ids, n_nodes = get_graph()
+            self._sent[w].put(handle, True)
+            self._tasks[w].put((job_id, handle, uv_ids, n_nodes, _costs, warm_start))
+
+        node_labels, errors = [None] * len(handles), []
+        for _ in range(len(handles)):
+            job_id, labels, error = self._get_result()
+            if error is not None:
+                errors.append(f"multicut of graph {handles[job_id]} failed: {error}")
+            node_labels[job_id] = labels
+        if len(errors) > 0:
+            # the worker caches might not match their mirrors anymore, the next solve starts new workers
+            self.close()
+            raise RuntimeError("\n".join(errors))
+        return node_labels
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                exit_codes = [worker.exitcode for worker in self._workers if not worker.is_alive()]
+                if len(exit_codes) > 0:
+                    # the tasks of a dead worker never finish, the remaining workers are stopped as well
+                    self._terminate()
+                    raise RuntimeError(f"{len(exit_codes)} multicut worker(s) died with exit codes {exit_codes}")
+
+    def _terminate(self):
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+
+    def close(self):
+        if self._workers is None:
+            return
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
@@ -0,0 +1,59 @@
+import numpy as np
+import nifty.graph.opt.multicut as nmc
+import elf.segmentation.multicut as mc
+
+
+def _greedy_additive(graph, costs, time_limit=None, n_threads=1):
+    return mc.multicut_gaec(graph, costs, time_limit=time_limit)
+
+
+def _kernighan_lin(graph, costs, time_limit=None, n_threads=1):
+    return mc.multicut_kernighan_lin(graph, costs, time_limit=time_limit)
+
+
+def _fusion_moves(graph, costs, time_limit=None, n_threads=1):
+    return mc.multicut_fusion_moves(graph, costs, time_limit=time_limit, n_threads=n_threads)
+
+
+def _decomposition(graph, costs, time_limit=None, n_threads=1):
+    return mc.multicut_decomposition(graph, costs, time_limit=time_limit, n_threads=n_threads,
+                                     internal_solver='greedy-additive')
+
+
+# all solvers take the graph, the edge costs, a wall clock budget in seconds (None for no limit) and a thread count
+# (ignored by the single threaded ones) and return a label for every node
+MULTICUT_SOLVERS = {"greedy-additive": _greedy_additive,
+                    "kernighan-lin": _kernighan_lin,
+                    "fusion-moves": _fusion_moves,
+                    "decomposition": _decomposition}
+
+
+def solve_multicut(graph, costs, solver="decomposition", time_limit=None, n_threads=1):
+    """multicut of one superpixel graph with a solver of MULTICUT_SOLVERS"""
+    if solver not in MULTICUT_SOLVERS:
+        raise ValueError(f"unknown multicut solver {solver}, choose from {list(MULTICUT_SOLVERS.keys())}")
+    return MULTICUT_SOLVERS[solver](graph, costs, time_limit, n_threads)
+
+
+def get_solver_kwargs(cfg, phase="explore"):
+    """
+    reads the solver of a phase ("explore" or "validation") from the config entry explore_multicut_solver or
+    val_multicut_solver, a dict with name, time_limit and n_threads
+    """
+    solver_cfg = cfg.get("val_multicut_solver" if phase == "validation" else "explore_multicut_solver", None) or {}
+    return {"solver": solver_cfg.get("name", "decomposition"), "time_limit": solver_cfg.get("time_limit", None),
+            "n_threads": solver_cfg.get("n_threads", 4)}
+
+
+def multicut_energy(graph, costs, node_labels):
+    """energy of a multicut solution, the sum of the costs of the cut edges (lower is better)"""
+    return nmc.multicutObjective(graph, costs).evalNodeLabels(np.asarray(node_labels, dtype=np.uint64))
+
+
+def kernighan_lin_from(graph, costs, node_labels, time_limit=None):
+    """Kernighan-Lin local search that starts from node_labels instead of a greedy-additive solution"""
+    objective = nmc.multicutObjective(graph, costs)
+    solver = objective.kernighanLinFactory(warmStartGreedy=False).create(objective)
+    # the visitor stops the solver after time_limit seconds, like the time limits of the elf solvers
+    visitor = None if time_limit is None else objective.verboseVisitor(visitNth=100000000, timeLimitSolver=time_limit)
+    return solver.optimize(visitor=visitor, nodeLabels=np.asarray(node_labels, dtype=np.uint64))
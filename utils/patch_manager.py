@@ -1,6 +1,53 @@
 import torch
 import numpy as np
 
+
+def _wrapped_slices(start, length, size):
+    """splits the window [start, start + length) on a periodic axis of size into at most two (src, dst) slices"""
+    start = start % size
+    if start + length <= size:
+        return [(slice(start, start + length), slice(0, length))]
+    n_first = size - start
+    return [(slice(start, size), slice(0, n_first)), (slice(0, length - n_first), slice(n_first, length))]
+
+
+def _empty(like, shape, dtype=None):
+    if torch.is_tensor(like):
+        return torch.empty(shape, dtype=like.dtype if dtype is None else dtype, device=like.device)
+    return np.empty(shape, dtype=like.dtype if dtype is None else dtype)
+
+
+def read_slices(dataset, slices, patch_shape, dtype=None, out=None):
+    """
+    reads a patch from an array like (h5py dataset, np.ndarray, np.memmap, torch.Tensor) by only accessing the given
+    hyperslabs
+    :param dataset: array like of shape (..., H, W)
+    :param slices: list of (src, dst) pairs of 2d slices as returned by get_patch_slices
+    :param patch_shape: spatial shape of the patch
+    :param out: optional preallocated output of shape (..., *patch_shape). If not given, a patch that consists of a
+                single hyperslab is returned as a view if dataset supports views
+    :return: array of shape (..., *patch_shape)
+    """
+    if out is None and len(slices) == 1:
+        (src_y, src_x), _ = slices[0]
+        out = dataset[..., src_y, src_x]
+        return out if dtype is None else out.astype(dtype, copy=False)
+    if out is None:
+        out = _empty(dataset, tuple(dataset.shape[:-2]) + tuple(int(s) for s in patch_shape), dtype)
+    for (src_y, src_x), (dst_y, dst_x) in slices:
+        out[..., dst_y, dst_x] = dataset[..., src_y, src_x]
+    return out
+
+
+def stack_patches(pm, image, indices, patch_shape, out=None):
+    """copies the patches of image at indices into out, which is allocated with shape (N, ..., *patch_shape) if None"""
+    if out is None:
+        out = _empty(image, (len(indices),) + tuple(image.shape[:-2]) + tuple(int(s) for s in patch_shape))
+    for i, index in enumerate(indices):
+        read_slices(image, pm.get_patch_slices(index), patch_shape, out=out[i])
+    return out
+
+
 class StridedRollingPatches2D():
     """patches on projective plane of image"""
     def __init__(self, strides, patch_shape, shape):
@@ -12,17 +59,33 @@ class StridedRollingPatches2D():
         self.shape = np.array(shape)
         self.patch_shape = np.array(patch_shape)
         self.n_patch_per_dim = self.shape // self.strides
+        self.index_key = "rotated_" + "_".join(map(str, [*self.strides, *self.patch_shape, *self.shape]))
 
-    def get_patch(self, image, index):
+    def _patch_origin(self, index):
         idx1 = index // self.n_patch_per_dim[1]
         idx2 = index % self.n_patch_per_dim[1]
 
         idx1 *= self.strides[0]
         idx2 *= self.strides[1]
+        return idx1, idx2
 
-        rolled_img = image.roll([idx1, idx2], [-2, -1])
-        patch = rolled_img[..., :self.patch_shape[0], :self.patch_shape[1]]
-        return patch
+    def get_patch(self, image, index, out=None):
+        """returns a view into image if the patch does not wrap around, otherwise a patch assembled into out"""
+        return read_slices(image, self.get_patch_slices(index), self.patch_shape, out=out)
+
+    def get_patches(self, image, indices, out=None):
+        return stack_patches(self, image, indices, self.patch_shape, out)
+
+    def get_patch_slices(self, index):
+        """returns the at most four (src, dst) hyperslabs that compose the patch at index"""
+        idx1, idx2 = self._patch_origin(int(index))
+        # rolling by idx moves pixel -idx to the patch origin
+        slc_y = _wrapped_slices(-int(idx1), int(self.patch_shape[0]), int(self.shape[0]))
+        slc_x = _wrapped_slices(-int(idx2), int(self.patch_shape[1]), int(self.shape[1]))
+        return [((sy, sx), (dy, dx)) for sy, dy in slc_y for sx, dx in slc_x]
+
+    def read_patch(self, dataset, index, dtype=None):
+        return read_slices(dataset, self.get_patch_slices(index), self.patch_shape, dtype)
 
 
 class StridedPatches2D():
@@ -36,8 +99,9 @@ class StridedPatches2D():
         self.shape = np.array(shape)
         self.patch_shape = np.array(patch_shape)
         self.n_patch_per_dim = ((self.shape - self.patch_shape) // self.strides) + 1
+        self.index_key = "no_cross_" + "_".join(map(str, [*self.strides, *self.patch_shape, *self.shape]))
 
-    def get_patch(self, image, index):
+    def _patch_origin(self, index):
         idx1 = index // self.n_patch_per_dim[0]
         idx2 = index % self.n_patch_per_dim[1]
 
@@ -45,16 +109,44 @@ class StridedPatches2D():
         idx2 *= self.strides[1]
         idx1 = self.shape[0] - self.patch_shape[0] if idx1 > self.shape[0] - self.patch_shape[0] else idx1
         idx2 = self.shape[1] - self.patch_shape[1] if idx2 > self.shape[1] - self.patch_shape[1] else idx2
+        return idx1, idx2
+
+    def get_patch(self, image, index, out=None):
+        """returns a view into image, or a copy in out if given"""
+        return read_slices(image, self.get_patch_slices(index), self.patch_shape, out=out)
+
+    def get_patches(self, image, indices, out=None):
+        return stack_patches(self, image, indices, self.patch_shape, out)
 
-        rolled_img = image.roll([-idx1, -idx2], [-2, -1])
-        patch = rolled_img[..., :self.patch_shape[0], :self.patch_shape[1]]
-        return patch
+    def get_patch_slices(self, index):
+        """returns the single (src, dst) hyperslab of the patch at index"""
+        idx1, idx2 = (int(i) for i in self._patch_origin(int(index)))
+        src = (slice(idx1, idx1 + int(self.patch_shape[0])), slice(idx2, idx2 + int(self.patch_shape[1])))
+        dst = (slice(0, int(self.patch_shape[0])), slice(0, int(self.patch_shape[1])))
+        return [(src, dst)]
+
+    def read_patch(self, dataset, index, dtype=None):
+        return read_slices(dataset, self.get_patch_slices(index), self.patch_shape, dtype)
 
 
 class NoPatches2D():
 
     def __init__(self):
         self.n_patch_per_dim = [1, 1]
+        self.index_key = "none"
+
+    def get_patch(self, image, index, out=None):
+        if out is None:
+            return image
+        out[...] = image
+        return out
+
+    def get_patches(self, image, indices, out=None):
+        return stack_patches(self, image, indices, image.shape[-2:], out)
+
+    def get_patch_slices(self, index):
+        return [((slice(None), slice(None)), (slice(None), slice(None)))]
 
-    def get_patch(self, image, index):
-        return image
+    def read_patch(self, dataset, index, dtype=None):
+        out = dataset[...]
+        return out if dtype is None else out.astype(dtype, copy=False)
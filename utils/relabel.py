@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+
+def relabel_consecutive(seg, return_labels=False):
+    """
+    maps the labels in seg to consecutive ints starting at 0 while keeping their order. Works for torch tensors
+    (on any device) and numpy arrays without building one-hot masks.
+    :param seg: label image of arbitrary shape
+    :param return_labels: if true, also returns the sorted original labels, such that labels[new_seg] == seg
+    """
+    if torch.is_tensor(seg):
+        labels, new_seg = torch.unique(seg, return_inverse=True)
+    else:
+        labels, new_seg = np.unique(seg, return_inverse=True)
+        new_seg = new_seg.reshape(seg.shape)
+    if return_labels:
+        return new_seg, labels
+    return new_seg
+
+
+def relabel_with_lut(seg, labels, new_labels, default=0):
+    """
+    replaces each occurrence of labels[i] in seg with new_labels[i] using a lookup table. All other labels are set to
+    default. Labels have to be non negative.
+    """
+    if torch.is_tensor(seg):
+        labels = torch.as_tensor(labels, device=seg.device).long()
+        new_labels = torch.as_tensor(new_labels, device=seg.device)
+        n_lut = max(int(seg.max()), int(labels.max()) if len(labels) else 0) + 1
+        lut = torch.full((n_lut,), default, dtype=new_labels.dtype, device=seg.device)
+        lut[labels] = new_labels
+        return lut[seg.long()]
+    labels, new_labels = np.asarray(labels, dtype=np.int64), np.asarray(new_labels)
+    n_lut = max(int(seg.max()), int(labels.max()) if len(labels) else 0) + 1
+    lut = np.full(n_lut, default, dtype=new_labels.dtype)
+    lut[labels] = new_labels
+    return lut[seg]
+
+
+def majority_projection(over_seg, seg):
+    """
+    for every label in over_seg returns the label in seg that overlaps most with it (ties go to the smaller label).
+    :return: the consecutive over_seg labels and the majority seg label for each of them
+    """
+    over_seg, _ = relabel_consecutive(over_seg, return_labels=True)
+    seg, seg_labels = relabel_consecutive(seg, return_labels=True)
+    n_over, n_seg = int(over_seg.max()) + 1, len(seg_labels)
+    if torch.is_tensor(over_seg):
+        counts = torch.bincount((over_seg * n_seg + seg).flatten(), minlength=n_over * n_seg).view(n_over, n_seg)
+    else:
+        counts = np.bincount((over_seg * n_seg + seg).ravel(), minlength=n_over * n_seg).reshape(n_over, n_seg)
+    return over_seg, seg_labels[counts.argmax(1)]
@@ -0,0 +1,142 @@
+import math
+import random
+import torch
+from torch_scatter import scatter_max
+from utils.lru_cache import LruCache
+
+
+class DenseSubgraphSampler(object):
+    """
+    samples connected subgraphs with a fixed number of edges from the graphs of a BatchedGraph. Every subgraph starts
+    at a random seed edge and grows by one edge adjacent to its nodes per step, edges between nodes that are already
+    in the subgraph are preferred, which keeps the subgraphs dense. All subgraphs of a batch grow at once on the
+    device of the graph. With resample_prob < 1 results are cached per graph key, and repeated episodes on the same
+    image reuse them until they are sampled again with probability resample_prob.
+    """
+
+    def __init__(self, seed=0, density_weight=10., cache_size=1024, resample_prob=1.):
+        assert 0 <= resample_prob <= 1
+        self.seed = seed
+        self.density_weight = density_weight
+        self.resample_prob = resample_prob
+        self.cache = LruCache(cache_size)
+        self._rng = random.Random(seed)
+        self._generators = {}
+
+    def _generator(self, device):
+        key = str(device)
+        if key not in self._generators:
+            self._generators[key] = torch.Generator(device=device)
+            self._generators[key].manual_seed(self.seed)
+        return self._generators[key]
+
+    def sample(self, graph, sz, keys=None):
+        """
+        :param graph: BatchedGraph
+        :param sz: number of edges per subgraph
+        :param keys: optional hashable key per graph (e.g. (file, patch)) under which the subgraphs are cached if
+                     resample_prob < 1
+        :return: list with a tensor of shape (n_subgraphs, sz) per graph, holding the indices of the subgraph edges in
+                 graph.edge_index. A graph with E edges gets ceil(E / sz) subgraphs.
+        """
+        use_cache = keys is not None and self.resample_prob < 1
+        local = [None] * graph.n_graphs
+        if use_cache:
+            local = [None if self._rng.random() < self.resample_prob else self.cache.get((key, sz)) for key in keys]
+        missing = [i for i, sgs in enumerate(local) if sgs is None]
+        if len(missing) > 0:
+            for i, sgs in zip(missing, self._sample_graphs(graph, missing, sz)):
+                local[i] = sgs - graph.edge_offsets[i]
+                if use_cache:
+                    self.cache.put((keys[i], sz), local[i])
+        return [sgs.to(graph.device) + off for sgs, off in zip(local, graph.edge_offsets)]
+
+    def _sample_graphs(self, graph, graph_ids, sz):
+        dev = graph.device
+        gen = self._generator(dev)
+        n_edges = [graph.edge_offsets[i + 1] - graph.edge_offsets[i] for i in graph_ids]
+        assert min(n_edges) >= sz, "graphs need at least as many edges as the subgraphs"
+        n_sgs = [math.ceil(n / sz) for n in n_edges]
+
+        # seed edges are drawn without replacement within each graph
+        seeds = [torch.randperm(n, generator=gen, device=dev)[:n_sg] + graph.edge_offsets[i]
+                 for i, n, n_sg in zip(graph_ids, n_edges, n_sgs)]
+        seeds = torch.cat(seeds)
+        chosen = self._grow(graph, seeds, sz, gen)
+        return torch.split(chosen, n_sgs)
+
+    def _grow(self, graph, seeds, sz, gen):
+        dev, n_sg, n_edges = graph.device, len(seeds), graph.n_edges
+        row_ptr, col, perm = graph.get_csr()
+        sg_range = torch.arange(n_sg, device=dev)
+
+        chosen = torch.full((n_sg, sz), -1, dtype=torch.long, device=dev)
+        # edges of a disconnected subgraph can bring two new nodes, so sz edges have at most 2 * sz nodes
+        nodes = torch.full((n_sg, 2 * sz), -1, dtype=torch.long, device=dev)
+        chosen[:, 0] = seeds
+        nodes[:, :2] = graph.edge_index[:, seeds].t()
+        n_in = torch.full((n_sg,), 2, dtype=torch.long, device=dev)
+        for t in range(1, sz):
+            # all directed edges that leave the nodes of a subgraph are candidates
+            node_mask = torch.arange(2 * sz, device=dev)[None] < n_in[:, None]
+            cand_nodes = nodes[node_mask]
+            degrees = row_ptr[cand_nodes + 1] - row_ptr[cand_nodes]
+            cand_sg = torch.repeat_interleave(sg_range[:, None].expand_as(nodes)[node_mask], degrees)
+            first = torch.repeat_interleave(row_ptr[cand_nodes] - (torch.cumsum(degrees, 0) - degrees), degrees)
+            pos = first + torch.arange(len(cand_sg), device=dev)
+            cand_edges, cand_other = perm[pos] % n_edges, col[pos]
+
+            is_chosen = (chosen[cand_sg, :t] == cand_edges[:, None]).any(1)
+            is_dense = (nodes[cand_sg] == cand_other[:, None]).any(1)
+            # gumbel max trick, samples one candidate per subgraph with probability proportional to its weight
+            uniform = torch.rand(len(cand_sg), generator=gen, device=dev).clamp_(min=1e-10)
+            keys = torch.log(1 + is_dense.float() * (self.density_weight - 1)) - torch.log(-torch.log(uniform))
+            keys[is_chosen] = -float("inf")
+            best, arg = scatter_max(keys, cand_sg, dim_size=n_sg)
+            valid = (arg < len(keys)) & (best > -float("inf"))
+            arg = arg[valid]
+
+            chosen[valid, t] = cand_edges[arg]
+            new_node = valid.clone()
+            new_node[valid] = ~is_dense[arg]
+            nodes[new_node, n_in[new_node]] = cand_other[arg[~is_dense[arg]]]
+            n_in += new_node.long()
+            if not valid.all():
+                self._fill_disconnected(graph, chosen, nodes, n_in, torch.nonzero(~valid).squeeze(1), t, gen)
+        return chosen
+
+    def _fill_disconnected(self, graph, chosen, nodes, n_in, sg_ids, t, gen):
+        """subgraphs whose component is exhausted continue with a random unused edge of the same graph"""
+        dev = graph.device
+        edge_offsets = torch.as_tensor(graph.edge_offsets, device=dev)
+        graph_ids = torch.searchsorted(edge_offsets[1:], chosen[sg_ids, 0], right=True)
+        start = edge_offsets[graph_ids]
+        n_unused = edge_offsets[graph_ids + 1] - start - t
+        # the k-th unused edge skips all used edges up to it. Those are the sorted used edges whose position minus
+        # their rank is at most k, the t edges of a subgraph are distinct and all lie in its graph
+        k = (torch.rand(len(sg_ids), generator=gen, device=dev) * n_unused).long().clamp_(max=n_unused - 1)
+        used = torch.sort(chosen[sg_ids, :t] - start[:, None], 1)[0]
+        n_skipped = (used - torch.arange(t, device=dev) <= k[:, None]).sum(1)
+        edges = start + k + n_skipped
+        chosen[sg_ids, t] = edges
+
+        for node in graph.edge_index[:, edges]:
+            # unused slots of nodes are -1 and never match
+            is_new = ~(nodes[sg_ids] == node[:, None]).any(1)
+            nodes[sg_ids[is_new], n_in[sg_ids[is_new]]] = node[is_new]
+            n_in[sg_ids] += is_new.long()
+
+def separate_subgraphs(subgraphs):
+    """
+    relabels the nodes of every subgraph to 0..n-1 in order of their ids, such that the subgraphs form disjoint graphs
+    :param subgraphs: tensor of shape (2, n_subgraphs, sz), node pairs of the subgraph edges
+    :return: tensor of the same shape with the node ids local to each subgraph
+    """
+    n_sg, sz = subgraphs.shape[1:]
+    nodes = subgraphs.permute(1, 0, 2).reshape(n_sg, 2 * sz)
+    sorted_nodes = torch.sort(nodes, 1)[0]
+    is_new = torch.ones_like(sorted_nodes)
+    is_new[:, 1:] = (sorted_nodes[:, 1:] != sorted_nodes[:, :-1]).long()
+    dense_rank = torch.cumsum(is_new, 1) - 1
+    local = torch.gather(dense_rank, 1, torch.searchsorted(sorted_nodes, nodes))
+    return local.view(n_sg, 2, sz).permute(1, 0, 2)
@@ -1,23 +1,119 @@
+import threading
+import queue
 import torch
-from elf.segmentation.features import compute_rag
+from utils.graphs import graph_from_uv_ids
+from utils.batched_graph import BatchedGraph
 
 
-def update_env_data(env, data_iter, data_set, device, with_gt_edges=False, fe_grad=False):
-    raw, gt, sp_seg, indices = next(data_iter)
-    rags = [compute_rag(sseg.numpy()) for sseg in sp_seg]
-    raw, gt, sp_seg = raw.to(device), gt.to(device), sp_seg.to(device)
-    edges, gt_edges, edge_feat, node_feat = data_set.get_graphs(indices, sp_seg, device)
-    # for e1, e2 in zip(edges, _edges):
-    #     assert not (e1 != e2).any()
+def prepare_env_data(env, batch, device, non_blocking=False):
+    raw, gt, sp_seg, indices, edges, gt_edges, edge_feat, node_feat, rags = batch
+    # nifty graphs are cached per (file, patch), so the multicut solver reuses them across data updates
+    keys = [tuple(idx.tolist()) for idx in indices]
+    rags = [env.graph_cache.get_or_compute(key, lambda: graph_from_uv_ids(*rag)) for key, rag in zip(keys, rags)]
+    raw, gt, sp_seg = [t.to(device, non_blocking=non_blocking) for t in (raw, gt, sp_seg)]
+    edges, gt_edges, edge_feat, node_feat = [None if data is None else [d.to(device, non_blocking=non_blocking)
+                                                                        for d in data]
+                                             for data in (edges, gt_edges, edge_feat, node_feat)]
 
-    env.update_data(edge_ids=edges, gt_edges=gt_edges, sp_seg=sp_seg, raw=raw, gt=gt, fe_grad=fe_grad, rags=rags,
-                    edge_feat=edge_feat, node_feat=node_feat)
+    return env.prepare_data(edge_ids=edges, gt_edges=gt_edges, sp_seg=sp_seg, raw=raw, gt=gt, rags=rags,
+                            edge_feat=edge_feat, node_feat=node_feat, keys=keys)
+
+
+def update_env_data(env, data_iter, device, with_gt_edges=False, fe_grad=False):
+    """loads the next batch of data_iter into env. data_iter can also be an EnvDataPrefetcher of env"""
+    if isinstance(data_iter, EnvDataPrefetcher):
+        env.set_data(data_iter.next_for(env))
+        return
+    env.set_data(prepare_env_data(env, next(data_iter), device))
+
+
+def _record_stream(data, stream):
+    if torch.is_tensor(data):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            _record_stream(d, stream)
+    elif isinstance(data, dict):
+        for d in data.values():
+            _record_stream(d, stream)
+    elif isinstance(data, BatchedGraph):
+        _record_stream(data.tensors(), stream)
+
+
+class EnvDataPrefetcher(object):
+    """
+    prepares the environment data of the next batches of data_iter in a background thread while the current
+    episodes run. Host to device copies are non blocking from the pinned DataLoader batches and happen on a side
+    cuda stream, the consumer stream waits for them before the data is used.
+    The batches are prepared by envs in turn, so every env keeps its own subgraph sampler and caches. The envs have
+    to load their data in the same order with next_for.
+    """
+    _done = object()
+
+    def __init__(self, envs, data_iter, device, n_prefetch=1):
+        self.envs = envs
+        self.data_iter = data_iter
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.queue = queue.Queue(maxsize=n_prefetch)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for i, batch in enumerate(self.data_iter):
+                env = self.envs[i % len(self.envs)]
+                if self.stream is None:
+                    item = (env, prepare_env_data(env, batch, self.device), None)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        data = prepare_env_data(env, batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    item = (env, data, event)
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._done)
+
+    def next_for(self, env):
+        """returns the next batch, which has to be prepared by env"""
+        item = self.queue.get()
+        if item is self._done:
+            self.queue.put(item)  # keep raising StopIteration on further calls
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        prepared_by, data, event = item
+        assert prepared_by is env, "the envs load their data in another order than they were prefetched for"
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            _record_stream(data, current_stream)
+        return data
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
 
 
 def state_to_cpu(state, state_class):
     state = list(state)
     for i in range(len(state)):
-        if torch.is_tensor(state[i]):
+        if torch.is_tensor(state[i]) or isinstance(state[i], BatchedGraph):
             state[i] = state[i].cpu()
         elif isinstance(state[i], list) or isinstance(state[i], tuple):
             state[i] = state_to_cpu(state[i], None)
@@ -29,7 +125,7 @@ def state_to_cpu(state, state_class):
 def state_to_cuda(state, device, state_class):
     state = list(state)
     for i in range(len(state)):
-        if torch.is_tensor(state[i]):
+        if torch.is_tensor(state[i]) or isinstance(state[i], BatchedGraph):
             state[i] = state[i].to(device)
         elif isinstance(state[i], list) or isinstance(state[i], tuple):
             state[i] = state_to_cuda(state[i], device, None)